@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Beverley Sun
+# bsun448
+
+'''Benchmarks Small without mounting it. Each benchmark formats a fresh
+    image in a temporary directory and calls the operations the way FUSE
+    would, then reports ops/s, latency percentiles and block I/O per op.
+'''
+
+from __future__ import print_function, division
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import cache
+import disktools
+import format
+import small
+
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_NUM_BLOCKS = 16384
+DEFAULT_COUNT = 2000
+
+#operations outside a mount have no calling process to take the owner from
+def fuse_get_context():
+    return (os.getuid(), os.getgid(), os.getpid())
+
+small.fuse_get_context = fuse_get_context
+
+class Bench(object):
+    '''A freshly formatted image with Small mounted on it.'''
+    def __init__(self, image, block_size, num_blocks, cache_blocks):
+        format.format_disk(image, block_size, num_blocks, owner=fuse_get_context()[:2])
+        cache.configure(cache_blocks)
+        self.fs = small.Small(image)
+        self.latencies = []
+        self.started = None
+
+    def __call__(self, op, *args):
+        return self.fs(op, *args)
+
+    def timed(self, op, *args):
+        start = perf_counter()
+        result = self.fs(op, *args)
+        self.latencies.append(perf_counter() - start)
+        return result
+
+    def start(self):
+        '''Ends the setup: commits it and starts counting.'''
+        #flush(2) leaves dirty blocks alone, so commit the way the writeback timer does
+        cache.flush()
+        device = disktools.get_device()
+        self.started = (perf_counter(), device.reads, device.writes, device.syncs)
+
+    def measure(self, run):
+        '''Runs run(self) and reports on the operations it timed.'''
+        run(self)
+        start, reads, writes, syncs = self.started
+        elapsed = perf_counter() - start
+        #writing everything back is part of the cost of the operations
+        cache.flush()
+        flush_elapsed = perf_counter() - start - elapsed
+        device = disktools.get_device()
+        ops = len(self.latencies)
+        return dict(
+            ops=ops,
+            seconds=elapsed,
+            flush_seconds=flush_elapsed,
+            ops_per_sec=ops / elapsed,
+            latency_us=percentiles(self.latencies),
+            block_reads_per_op=(device.reads - reads) / ops,
+            block_writes_per_op=(device.writes - writes) / ops,
+            fsyncs=device.syncs - syncs
+        )
+
+    def close(self):
+        self.fs('destroy', '/')
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1e6
+    return dict(p50=at(0.5), p90=at(0.9), p99=at(0.99), max=ordered[-1] * 1e6)
+
+def create_file(b, path):
+    b('release', path, b('create', path, 0o644))
+
+def write_file(b, path, size, chunk):
+    fh = b('create', path, 0o644)
+    data = os.urandom(chunk)
+    for offset in range(0, size, chunk):
+        b('write', path, data, offset, fh)
+    b('release', path, fh)
+
+#each benchmark sets up what it needs, then calls start() before the timed operations
+def bench_create(count):
+    def run(b):
+        b('mkdir', '/d', 0o755)
+        b.start()
+        for i in range(count):
+            fh = b.timed('create', '/d/f%d' % i, 0o644)
+            b('release', '/d/f%d' % i, fh)
+    return run
+
+def bench_mkdir(count):
+    def run(b):
+        b.start()
+        for i in range(count):
+            b.timed('mkdir', '/d%d' % i, 0o755)
+    return run
+
+def bench_seq_write(count, chunk):
+    def run(b):
+        data = os.urandom(chunk)
+        fh = b('create', '/f', 0o644)
+        b.start()
+        for i in range(count):
+            b.timed('write', '/f', data, i * chunk, fh)
+        b('release', '/f', fh)
+    return run
+
+def bench_seq_read(count, chunk):
+    def run(b):
+        write_file(b, '/f', count * chunk, chunk)
+        b.start()
+        fh = b('open', '/f', 0)
+        for i in range(count):
+            b.timed('read', '/f', chunk, i * chunk, fh)
+        b('release', '/f', fh)
+    return run
+
+def bench_rand_write(count, chunk):
+    def run(b):
+        rnd = random.Random(1)
+        write_file(b, '/f', count * chunk, chunk)
+        b.start()
+        data = os.urandom(chunk)
+        fh = b('open', '/f', 0)
+        for _ in range(count):
+            b.timed('write', '/f', data, rnd.randrange(count) * chunk, fh)
+        b('release', '/f', fh)
+    return run
+
+def bench_rand_read(count, chunk):
+    def run(b):
+        rnd = random.Random(1)
+        write_file(b, '/f', count * chunk, chunk)
+        b.start()
+        fh = b('open', '/f', 0)
+        for _ in range(count):
+            b.timed('read', '/f', chunk, rnd.randrange(count) * chunk, fh)
+        b('release', '/f', fh)
+    return run
+
+def bench_readdir(count):
+    def run(b):
+        b('mkdir', '/d', 0o755)
+        for i in range(count):
+            create_file(b, '/d/f%d' % i)
+        b.start()
+        for _ in range(max(1, 20000 // count)):
+            b.timed('readdir', '/d', 0)
+    return run
+
+def bench_getattr(count):
+    def run(b):
+        b('mkdir', '/d', 0o755)
+        for i in range(count):
+            create_file(b, '/d/f%d' % i)
+        b.start()
+        for i in range(count):
+            b.timed('getattr', '/d/f%d' % i)
+    return run
+
+def bench_truncate(count, chunk):
+    def run(b):
+        for i in range(count):
+            write_file(b, '/f%d' % i, 4 * chunk, chunk)
+        b.start()
+        for i in range(count):
+            b.timed('truncate', '/f%d' % i, chunk // 2)
+    return run
+
+def bench_unlink(count, chunk):
+    def run(b):
+        for i in range(count):
+            write_file(b, '/f%d' % i, chunk, chunk)
+        b.start()
+        for i in range(count):
+            b.timed('unlink', '/f%d' % i)
+    return run
+
+def benchmarks(count):
+    small_chunk, large_chunk = 4096, 65536
+    return [
+        ('create', bench_create(count)),
+        ('mkdir', bench_mkdir(count)),
+        ('seq_write_4k', bench_seq_write(count, small_chunk)),
+        ('seq_write_64k', bench_seq_write(count // 8, large_chunk)),
+        ('seq_read_4k', bench_seq_read(count, small_chunk)),
+        ('seq_read_64k', bench_seq_read(count // 8, large_chunk)),
+        ('rand_write_4k', bench_rand_write(count, small_chunk)),
+        ('rand_read_4k', bench_rand_read(count, small_chunk)),
+        ('readdir', bench_readdir(count)),
+        ('getattr', bench_getattr(count)),
+        ('truncate', bench_truncate(count // 4, small_chunk)),
+        ('unlink', bench_unlink(count // 4, small_chunk)),
+    ]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+        cache_blocks=cache.DEFAULT_CAPACITY, count=DEFAULT_COUNT, only=None):
+    '''Return: a dict of the configuration and the results of each benchmark.'''
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='small-bench-')
+    try:
+        for name, run in benchmarks(count):
+            if only and name not in only:
+                continue
+            b = Bench(os.path.join(workdir, 'disk'), block_size, num_blocks, cache_blocks)
+            try:
+                results[name] = b.measure(run)
+            finally:
+                b.close()
+    finally:
+        shutil.rmtree(workdir)
+    return dict(
+        commit=git_commit(),
+        python=sys.version.split()[0],
+        block_size=block_size,
+        num_blocks=num_blocks,
+        cache_blocks=cache_blocks,
+        count=count,
+        results=results
+    )
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--num-blocks', type=int, default=DEFAULT_NUM_BLOCKS)
+    parser.add_argument('--cache-blocks', type=int, default=cache.DEFAULT_CAPACITY)
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help='operations per benchmark')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run, all of them by default')
+    parser.add_argument('--output', help='file to write the JSON report to instead of stdout')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.block_size, args.num_blocks, args.cache_blocks, args.count, args.only)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -1,37 +1,372 @@
-# Beverley Sun
-# bsun448
-
-import math
-
-BITMAP_FILE_NAME = "bitmap"
-
-def set_bit(offset_from_left):
-    offset = 15 - offset_from_left
-    mask = 1 << offset
-    map = read_bitmap() | mask
-    write_map_to_file(bin(map))
-    return map
-
-def clear_bit(offset_from_left):
-    offset = 15 - offset_from_left
-    mask = ~(1 << offset)
-    map = read_bitmap() & mask
-    write_map_to_file(bin(map))
-    return map
-
-def next_avail_block_num():
-    map = read_bitmap()
-    map_str = bin(read_bitmap())[2:]
-    return map_str.find("0")
-    
-def num_avail_blocks():
-    map_str = bin(read_bitmap())[2:]
-    return map_str.count("0")
-
-def write_map_to_file(map):
-    with open(BITMAP_FILE_NAME, "w") as bitmap:
-            bitmap.write(map)
-
-def read_bitmap():
-    with open(BITMAP_FILE_NAME, "r") as bitmap:
-        return int(bitmap.readline(), 2)
\ No newline at end of file
+# Beverley Sun
+# bsun448
+
+import re
+import threading
+from disktools import BLOCK_SIZE, NUM_BLOCKS
+from cache import read_blocks, write_blocks, register_commit_hook
+
+BITMAP_START = 1
+FREE_BYTE = re.compile(b"[^\xff]")
+
+class Reservation(object):
+    '''A run of free blocks set aside for one file so the blocks it
+        allocates next are contiguous. The blocks stay free on disk until
+        they are allocated, and are taken back when nothing else is free.
+    '''
+    __slots__ = ('next', 'end')
+
+    def __init__(self):
+        self.next = self.end = 0
+
+    def __len__(self):
+        return self.end - self.next
+
+def bitmap_blocks(num_blocks, block_size):
+    '''Return: the number of blocks needed to hold one bit per block.'''
+    return -(-num_blocks // (8 * block_size))
+
+class Bitmap(object):
+    '''Free-space map kept in memory as packed bits, one per block with the
+        most significant bit of each byte first. It lives in the blocks from
+        start_block onwards and only blocks holding changed bits are written
+        back on flush(). Every method holds the bitmap's lock, so allocate()
+        never hands the same block to two threads.
+
+        Free blocks can also be reserved for a file (see Reservation), which
+        only lives in memory, and promised to data that is not allocated yet.
+        Promised blocks do not count as available to anything else.
+
+        Freed blocks are held, like reserved ones, until take_freed() at the
+        next commit, since the committed state may still use them: reusing
+        one would put it in the journal. They are only handed out earlier
+        when nothing else is free.
+    '''
+    def __init__(self, num_blocks=NUM_BLOCKS, block_size=BLOCK_SIZE, start_block=BITMAP_START):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.start_block = start_block
+        self.num_map_blocks = bitmap_blocks(num_blocks, block_size)
+        self.bits = bytearray(self.num_map_blocks * block_size)
+        self.reserved = bytearray(len(self.bits)) #packed like bits
+        self.reservations = set()
+        self.promised = 0
+        self.dirty = set() #bitmap blocks with unwritten changes
+        self.freed = set() #blocks cleared since the last take_freed()
+        self.held = set() #freed blocks not to be allocated before the next commit
+        self.hint = 0 #no byte before this one has a free bit
+        self.free = 0
+        self.lock = threading.RLock()
+        self.allocations = 0
+        self.failed_allocations = 0
+        self.frees = 0
+
+    def load(self):
+        blocks = read_blocks(range(self.start_block, self.start_block + self.num_map_blocks))
+        for i in range(self.num_map_blocks):
+            start = i * self.block_size
+            self.bits[start:start + self.block_size] = blocks[self.start_block + i]
+        self.dirty.clear()
+        self.freed.clear()
+        self.held.clear()
+        self.reserved[:] = bytes(len(self.reserved))
+        self.reservations.clear()
+        self.promised = 0
+        self.count_free()
+
+    def format(self, reserved_blocks):
+        '''Marks every block free except the first reserved_blocks.'''
+        self.bits[:] = bytes(len(self.bits))
+        self.mark_padding()
+        self.dirty = set(range(self.num_map_blocks))
+        self.count_free()
+        for block_num in range(reserved_blocks):
+            self.set_bit(block_num)
+
+    def mark_padding(self):
+        #bits past the last block are never free
+        for block_num in range(self.num_blocks, len(self.bits) * 8):
+            self.bits[block_num // 8] |= 0x80 >> (block_num % 8)
+
+    def count_free(self):
+        self.mark_padding()
+        used = bin(int.from_bytes(self.bits, "big")).count("1")
+        self.free = len(self.bits) * 8 - used
+        self.hint = 0
+
+    def set_bit(self, block_num):
+        index, mask = block_num // 8, 0x80 >> (block_num % 8)
+        with self.lock:
+            if not self.bits[index] & mask:
+                self.bits[index] |= mask
+                self.free -= 1
+                self.dirty.add(index // self.block_size)
+
+    def clear_bit(self, block_num):
+        index, mask = block_num // 8, 0x80 >> (block_num % 8)
+        with self.lock:
+            if self.bits[index] & mask:
+                self.bits[index] &= ~mask
+                self.free += 1
+                self.dirty.add(index // self.block_size)
+                self.freed.add(block_num)
+                self.held.add(block_num)
+                self.reserved[index] |= mask
+                self.frees += 1
+                if index < self.hint:
+                    self.hint = index
+
+    def is_set(self, block_num):
+        return bool(self.bits[block_num // 8] & (0x80 >> (block_num % 8)))
+
+    def is_free(self, block_num):
+        #free and not reserved
+        return not (self.bits[block_num // 8] | self.reserved[block_num // 8]) & (0x80 >> (block_num % 8))
+
+    def next_avail_block_num(self):
+        '''Return: the lowest free block number that is not reserved, or -1
+            if there is none.
+        '''
+        with self.lock:
+            if self.free == 0:
+                return -1
+            match = FREE_BYTE.search(self.bits, self.hint)
+            if match is None:
+                return -1
+            index = self.hint = match.start()
+            while True:
+                avail = ~(self.bits[index] | self.reserved[index]) & 0xff
+                if avail:
+                    return index * 8 + 8 - avail.bit_length()
+                match = FREE_BYTE.search(self.bits, index + 1)
+                if match is None:
+                    return -1
+                index = match.start()
+
+    def search_run(self, goal, count):
+        #whole bytes of free bits, so the run is at least count blocks
+        run = re.compile(b"\x00{%d}" % -(-count // 8))
+        for start, end in ((goal // 8, len(self.bits)), (self.hint, goal // 8)):
+            match = run.search(self.bits, start, end)
+            while match is not None:
+                if not any(self.reserved[match.start():match.end()]):
+                    return match.start() * 8
+                match = run.search(self.bits, match.start() + 1, end)
+        return -1
+
+    def find_run(self, goal, count):
+        '''Finds free blocks that are not reserved: from goal if it is free,
+            otherwise the first run of count blocks after goal (or before it),
+            otherwise the lowest free block.
+            Return: (start, length) with length at most count, or (-1, 0).
+        '''
+        with self.lock:
+            if 0 <= goal < self.num_blocks and self.is_free(goal):
+                start = goal
+            else:
+                start = self.search_run(goal, count)
+                if start == -1:
+                    start = self.next_avail_block_num()
+                    if start == -1:
+                        return -1, 0
+            length = 1
+            while length < count and start + length < self.num_blocks and self.is_free(start + length):
+                length += 1
+            return start, length
+
+    def reserve(self, reservation, goal, count):
+        '''Replaces what is left of reservation with up to count blocks
+            found by find_run(goal, count).
+            Return: the number of blocks reserved.
+        '''
+        with self.lock:
+            self.release(reservation)
+            start, length = self.find_run(goal, count)
+            for block_num in range(start, start + length):
+                self.reserved[block_num // 8] |= 0x80 >> (block_num % 8)
+            if length:
+                reservation.next, reservation.end = start, start + length
+                self.reservations.add(reservation)
+            return length
+
+    def release(self, reservation):
+        '''Hands back the blocks reservation has not allocated.'''
+        with self.lock:
+            for block_num in range(reservation.next, reservation.end):
+                self.reserved[block_num // 8] &= ~(0x80 >> (block_num % 8))
+            reservation.next = reservation.end
+            self.reservations.discard(reservation)
+
+    def allocate_reserved(self, reservation):
+        '''Marks the next block of reservation used.
+            Return: its block number, or -1 if reservation is used up.
+        '''
+        with self.lock:
+            if not reservation:
+                return -1
+            block_num = reservation.next
+            reservation.next += 1
+            self.reserved[block_num // 8] &= ~(0x80 >> (block_num % 8))
+            if not reservation:
+                self.reservations.discard(reservation)
+            self.set_bit(block_num)
+            self.allocations += 1
+            return block_num
+
+    def allocate(self, promised=False):
+        '''Marks the lowest free block used. Only promised allocations may
+            use blocks that have been promised.
+            Return: its block number, or -1 if the disk is full.
+        '''
+        with self.lock:
+            block_num = -1
+            if promised or self.free > self.promised:
+                block_num = self.next_avail_block_num()
+                if block_num == -1 and self.reservations:
+                    #the only free blocks left are reserved, so take them back
+                    for reservation in list(self.reservations):
+                        self.release(reservation)
+                    block_num = self.next_avail_block_num()
+                if block_num == -1 and self.held:
+                    self.release_held()
+                    block_num = self.next_avail_block_num()
+            if block_num == -1:
+                self.failed_allocations += 1
+            else:
+                self.set_bit(block_num)
+                self.allocations += 1
+            return block_num
+
+    def promise(self, count):
+        '''Sets count free blocks aside for data that will be allocated later.
+            Return: False if there are not that many available.
+        '''
+        with self.lock:
+            if count > self.free - self.promised:
+                return False
+            self.promised += count
+            return True
+
+    def unpromise(self, count):
+        with self.lock:
+            self.promised -= count
+
+    def num_avail_blocks(self):
+        return self.free - self.promised
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                blocks=self.num_blocks,
+                free=self.free,
+                promised=self.promised,
+                reservations=len(self.reservations),
+                allocations=self.allocations,
+                failed_allocations=self.failed_allocations,
+                frees=self.frees
+            )
+
+    def release_held(self):
+        #freed blocks become free for anything
+        for block_num in self.held:
+            self.reserved[block_num // 8] &= ~(0x80 >> (block_num % 8))
+        self.held.clear()
+
+    def freed_blocks(self):
+        '''Return: the blocks cleared since the last take_freed().'''
+        with self.lock:
+            return set(self.freed)
+
+    def take_freed(self):
+        '''Return: the blocks cleared since the last call, forgetting them.
+            They can be allocated again from now on.
+        '''
+        with self.lock:
+            freed, self.freed = self.freed, set()
+            self.release_held()
+            return freed
+
+    def flush(self):
+        '''Writes the bitmap blocks that changed since the last flush.'''
+        with self.lock:
+            write_blocks({self.start_block + i: self.bits[i * self.block_size:(i + 1) * self.block_size]
+                for i in self.dirty})
+            self.dirty.clear()
+
+_bitmap = None
+
+def load_bitmap(num_blocks=NUM_BLOCKS, block_size=BLOCK_SIZE, start_block=BITMAP_START):
+    '''Reads the bitmap of the mounted disk into memory.'''
+    global _bitmap
+    _bitmap = Bitmap(num_blocks, block_size, start_block)
+    _bitmap.load()
+    return _bitmap
+
+def get_bitmap():
+    if _bitmap is None:
+        load_bitmap()
+    return _bitmap
+
+def set_bit(block_num):
+    get_bitmap().set_bit(block_num)
+
+def clear_bit(block_num):
+    get_bitmap().clear_bit(block_num)
+
+def next_avail_block_num():
+    return get_bitmap().next_avail_block_num()
+
+def allocate(promised=False):
+    return get_bitmap().allocate(promised)
+
+def reserve(reservation, goal, count):
+    return get_bitmap().reserve(reservation, goal, count)
+
+def release(reservation):
+    if _bitmap is not None:
+        _bitmap.release(reservation)
+
+def allocate_reserved(reservation):
+    return get_bitmap().allocate_reserved(reservation)
+
+def find_run(goal, count):
+    return get_bitmap().find_run(goal, count)
+
+def promise(count):
+    return get_bitmap().promise(count)
+
+def unpromise(count):
+    get_bitmap().unpromise(count)
+
+def num_avail_blocks():
+    return get_bitmap().num_avail_blocks()
+
+def is_set(block_num):
+    return get_bitmap().is_set(block_num)
+
+def allocator_stats():
+    if _bitmap is None:
+        return {}
+    return _bitmap.stats()
+
+def freed_blocks():
+    if _bitmap is None:
+        return set()
+    return _bitmap.freed_blocks()
+
+def take_freed():
+    if _bitmap is None:
+        return set()
+    return _bitmap.take_freed()
+
+def flush():
+    if _bitmap is not None:
+        _bitmap.flush()
+
+def unload_bitmap():
+    '''Writes back and forgets the in-memory bitmap.'''
+    global _bitmap
+    flush()
+    _bitmap = None
+
+register_commit_hook(flush)
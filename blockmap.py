@@ -0,0 +1,161 @@
+# Beverley Sun
+# bsun448
+
+import os
+from errno import ENOSPC
+from byte_locations import BLOCKMAP_START, BYTEORDER, PTR_SIZE
+from cache import read_block, write_block
+from bitmap import allocate
+
+#a pointer to block 0 (the superblock) marks a hole that reads as zeros
+NO_BLOCK = 0
+
+class BlockMap(object):
+    '''Maps the block indexes of a file to disk blocks through the pointers
+        in its inode: direct pointers first, then one single and one double
+        indirect block. Any block can be found in at most three reads.
+    '''
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.ptrs_per_block = block_size // PTR_SIZE
+        self.num_direct = (block_size - BLOCKMAP_START) // PTR_SIZE - 2
+        self.indirect_slot = self.num_direct
+        self.double_indirect_slot = self.num_direct + 1
+        self.max_blocks = self.num_direct + self.ptrs_per_block + self.ptrs_per_block ** 2
+
+    def get_ptr(self, block, base, slot):
+        start = base + slot * PTR_SIZE
+        return int.from_bytes(block[start:start+PTR_SIZE], BYTEORDER)
+
+    def set_ptr(self, block, base, slot, block_num):
+        start = base + slot * PTR_SIZE
+        block[start:start+PTR_SIZE] = block_num.to_bytes(PTR_SIZE, BYTEORDER)
+
+    def path(self, index):
+        '''Return: the slot to follow in the inode, then in each indirect block.'''
+        if index < self.num_direct:
+            return [index]
+        index -= self.num_direct
+        if index < self.ptrs_per_block:
+            return [self.indirect_slot, index]
+        index -= self.ptrs_per_block
+        return [self.double_indirect_slot, index // self.ptrs_per_block, index % self.ptrs_per_block]
+
+    def lookup(self, inode, index):
+        '''Return: the disk block holding file block index, or NO_BLOCK for a hole.'''
+        if index >= self.max_blocks:
+            return NO_BLOCK
+        slots = self.path(index)
+        block_num = self.get_ptr(inode, BLOCKMAP_START, slots[0])
+        for slot in slots[1:]:
+            if block_num == NO_BLOCK:
+                break
+            block_num = self.get_ptr(read_block(block_num), 0, slot)
+        return block_num
+
+    def map_block(self, inode, index, allocator=None, target=None):
+        '''Allocates file block index and any indirect blocks on its path,
+            taking blocks from allocator() if it is given. With target, an
+            unmapped index is mapped to that block instead of a new one.
+            The inode is updated in place and left for the caller to write.
+            Return: (block_num, fresh) where fresh blocks have not been written.
+        '''
+        allocator = allocator or allocate_block
+        slots = self.path(index)
+        holder, holder_num, base = inode, None, BLOCKMAP_START
+        for depth, slot in enumerate(slots):
+            block_num = self.get_ptr(holder, base, slot)
+            fresh = block_num == NO_BLOCK
+            if fresh:
+                block_num = target if target is not None and depth == len(slots) - 1 else allocator()
+                self.set_ptr(holder, base, slot, block_num)
+                if holder_num is not None:
+                    write_block(holder_num, holder)
+            if depth < len(slots) - 1:
+                holder = bytearray(self.block_size) if fresh else read_block(block_num)
+                holder_num, base = block_num, 0
+        return block_num, fresh
+
+    def remap(self, inode, index, block_num):
+        '''Points the mapped file block index at block_num instead. The inode
+            is updated in place and left for the caller to write.
+            Return: the block it was mapped to before.
+        '''
+        slots = self.path(index)
+        holder, holder_num, base = inode, None, BLOCKMAP_START
+        for slot in slots[:-1]:
+            holder_num = self.get_ptr(holder, base, slot)
+            holder, base = read_block(holder_num), 0
+        old_block_num = self.get_ptr(holder, base, slots[-1])
+        self.set_ptr(holder, base, slots[-1], block_num)
+        if holder_num is not None:
+            write_block(holder_num, holder)
+        return old_block_num
+
+    def count_unmapped(self, inode, first, last):
+        '''Return: how many blocks mapping file blocks first..last would allocate.'''
+        return self.count_unmapped_indexes(inode, range(first, last + 1))
+
+    def count_unmapped_indexes(self, inode, indexes):
+        '''Return: how many blocks mapping the file blocks in indexes would allocate.'''
+        missing = set()
+        for index in indexes:
+            slots = self.path(index)
+            block_num = self.get_ptr(inode, BLOCKMAP_START, slots[0])
+            for depth in range(len(slots)):
+                if block_num == NO_BLOCK:
+                    #everything below a missing pointer is missing too
+                    for below in range(depth, len(slots)):
+                        missing.add(tuple(slots[:below + 1]))
+                    break
+                if depth < len(slots) - 1:
+                    block_num = self.get_ptr(read_block(block_num), 0, slots[depth + 1])
+        return len(missing)
+
+    def truncate(self, inode, first):
+        '''Unmaps file blocks from index first onwards, along with indirect
+            blocks that no longer map anything. The inode is updated in place.
+            Return: the block numbers that were unmapped, for the caller to free.
+        '''
+        freed = []
+        for slot in range(min(first, self.num_direct), self.num_direct):
+            block_num = self.get_ptr(inode, BLOCKMAP_START, slot)
+            if block_num != NO_BLOCK:
+                freed.append(block_num)
+                self.set_ptr(inode, BLOCKMAP_START, slot, NO_BLOCK)
+
+        first -= self.num_direct
+        for slot, level in ((self.indirect_slot, 1), (self.double_indirect_slot, 2)):
+            block_num = self.get_ptr(inode, BLOCKMAP_START, slot)
+            if block_num != NO_BLOCK and self.truncate_indirect(block_num, level, max(first, 0), freed):
+                self.set_ptr(inode, BLOCKMAP_START, slot, NO_BLOCK)
+            first -= self.ptrs_per_block ** level
+        return freed
+
+    def truncate_indirect(self, block_num, level, first, freed):
+        #return True if the whole indirect block was freed
+        span = self.ptrs_per_block ** (level - 1)
+        block = read_block(block_num)
+        changed = False
+        for slot in range(first // span, self.ptrs_per_block):
+            child = self.get_ptr(block, 0, slot)
+            if child == NO_BLOCK:
+                continue
+            if level == 1:
+                freed.append(child)
+            elif not self.truncate_indirect(child, level - 1, max(first - slot * span, 0), freed):
+                continue
+            self.set_ptr(block, 0, slot, NO_BLOCK)
+            changed = True
+        if first == 0:
+            freed.append(block_num)
+            return True
+        if changed:
+            write_block(block_num, block)
+        return False
+
+def allocate_block():
+    block_num = allocate()
+    if block_num == -1:
+        raise OSError(ENOSPC, os.strerror(ENOSPC))
+    return block_num
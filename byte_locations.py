@@ -1,30 +1,37 @@
-# Beverley Sun
-# bsun448
-
-NEXTBLOCKNUM_START = 0
-NEXTBLOCKNUM_END = 1
-MODE_START = 1
-MODE_END = 3
-UID_START = 3
-UID_END = 5
-GID_START = 5
-GID_END = 7
-NLINKS_START = 7
-NLINKS_END = 8
-SIZE_START = 8
-SIZE_END = 10
-CTIME_START = 10
-CTIME_END = 14
-MTIME_START = 14
-MTIME_END = 18
-ATIME_START = 18
-ATIME_END = 22
-NAME_START = 22
-NAME_END = 38
-LOCATION_START = 38
-LOCATION_END = 39
-DATA_START = 39
-DATA_END = 64
-
-OVERFLOW_DATA_START = 1
-OVERFLOW_DATA_END = 64
\ No newline at end of file
+# Beverley Sun
+# bsun448
+
+BYTEORDER = "little"
+STR_ENCODING = "utf-8"
+
+#block pointers (LOCATION, the block map and directory entries) are PTR_SIZE bytes
+PTR_SIZE = 4
+
+MODE_START = 0
+MODE_END = 2
+UID_START = 2
+UID_END = 6
+GID_START = 6
+GID_END = 10
+NLINKS_START = 10
+NLINKS_END = 14
+SIZE_START = 14
+SIZE_END = 22
+CTIME_START = 22
+CTIME_END = 26
+MTIME_START = 26
+MTIME_END = 30
+ATIME_START = 30
+ATIME_END = 34
+LOCATION_START = 34
+LOCATION_END = 38
+#the rest of the inode is the block map
+BLOCKMAP_START = 38
+
+#directory data blocks are arrays of DIRENT_SIZE entries
+DIRENT_SIZE = 64
+DIRENT_INODE_START = 0
+DIRENT_INODE_END = 4
+DIRENT_NAME_LEN = 4
+DIRENT_NAME_START = 5
+DIRENT_NAME_END = 64
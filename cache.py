@@ -0,0 +1,372 @@
+# Beverley Sun
+# bsun448
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import disktools
+
+DEFAULT_CAPACITY = 1024
+DEFAULT_WRITEBACK_INTERVAL = 5
+#blocks one transaction may journal besides the bitmap, which every
+#operation has to stay within
+TRANSACTION_BLOCKS = 24
+
+#called before every flush so in-memory metadata reaches the cache first
+flush_hooks = []
+#called before every commit, after the flush hooks, for in-memory state
+#they change; these must not allocate
+commit_hooks = []
+
+class BufferCache(object):
+    '''Write-back block cache with LRU eviction in front of disktools.
+        Blocks handed out are copies, so callers still have to write_block
+        anything they change. Dirty blocks reach the disk image when they are
+        evicted, on flush()/sync(), or from the writeback timer.
+
+        With a journal attached, changes are grouped into transactions and
+        flush() commits them through the journal once no transaction is
+        running. Dirty metadata is then never evicted, only committed, and
+        a transaction only starts once the journal has room for it, so a
+        commit never has to be split.
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.blocks = OrderedDict() #block num -> bytearray, least recently used first
+        self.dirty = set()
+        self.data = set() #dirty blocks last written as file data
+        self.discarded = set() #freed blocks, read as zeros and never written back
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.writeback_stop = None
+        self.writeback_thread = None
+        self.journal = None
+        self.journal_reserved = 0 #journal blocks kept for the commit hooks
+        self.active = 0 #running transactions
+        self.committing = False
+        self.idle = threading.Condition(self.lock)
+        self.commit_lock = threading.Lock()
+        self.commits = 0 #commits started
+        self.prefetched = 0
+
+    def read_block(self, block_num):
+        with self.lock:
+            if block_num in self.discarded:
+                return bytearray(disktools.get_device().block_size)
+            block = self.blocks.get(block_num)
+            if block is None:
+                self.misses += 1
+                block = disktools.read_block(block_num)
+                self.insert(block_num, block)
+            else:
+                self.hits += 1
+                self.blocks.move_to_end(block_num)
+            return bytearray(block)
+
+    def read_blocks(self, block_nums):
+        '''Return: {block num: bytearray copy} of the blocks in block_nums,
+            reading the ones that are not cached in one request.
+        '''
+        with self.lock:
+            found = {}
+            missing = []
+            for block_num in block_nums:
+                if block_num in self.discarded or block_num in self.blocks:
+                    found[block_num] = self.read_block(block_num)
+                else:
+                    missing.append(block_num)
+            self.misses += len(missing)
+            for block_num, block in disktools.read_blocks(missing).items():
+                self.insert(block_num, block)
+                found[block_num] = bytearray(block)
+            return found
+
+    def prefetch(self, block_nums):
+        '''Asks the kernel to start reading the blocks in block_nums that
+            are not cached yet, for reads that are expected soon. It only
+            advises, so the kernel reads them in the background and the
+            reads that follow copy pages that are already in memory.
+        '''
+        with self.lock:
+            missing = [n for n in block_nums if n not in self.blocks and n not in self.discarded]
+            self.prefetched += len(missing)
+        disktools.will_need(missing)
+
+    def write_block(self, block_num, data, metadata=True):
+        with self.lock:
+            block = self.blocks.get(block_num)
+            if len(data) < disktools.get_device().block_size:
+                #partial writes only replace the start of the block
+                if block_num in self.discarded:
+                    block = bytearray(disktools.get_device().block_size)
+                elif block is None:
+                    block = disktools.read_block(block_num)
+                block[:len(data)] = data
+            else:
+                block = bytearray(data)
+            #a freed block written again is journaled whatever it holds now,
+            #otherwise a dirty block keeps the kind it was first written as
+            journaled = block_num in self.discarded or block_num in self.dirty and block_num not in self.data
+            #dirty before insert() so the new block can't be the one evicted
+            self.dirty.add(block_num)
+            self.discarded.discard(block_num)
+            self.insert(block_num, block)
+            if metadata or journaled:
+                self.data.discard(block_num)
+            else:
+                self.data.add(block_num)
+
+    def write_blocks(self, blocks, metadata=True):
+        '''Writes {block num: data} like write_block, under one lock.'''
+        with self.lock:
+            for block_num, data in blocks.items():
+                self.write_block(block_num, data, metadata)
+
+    def discard_blocks(self, block_nums):
+        '''Forgets the blocks in block_nums, which have been freed. Until
+            the next commit they read as zeros. Their old contents are
+            never written back and not replaced with zeros either, since
+            every block is written in full when it is allocated again.
+        '''
+        with self.lock:
+            for block_num in block_nums:
+                self.blocks.pop(block_num, None)
+                self.dirty.add(block_num)
+                self.data.discard(block_num)
+                self.discarded.add(block_num)
+
+    def insert(self, block_num, block):
+        self.blocks[block_num] = block
+        self.blocks.move_to_end(block_num)
+        while len(self.blocks) > self.capacity:
+            if self.journal is not None:
+                #evict the least recently used block that is clean or file data,
+                #which can go home before the commit. Metadata waits for it
+                for old_num in self.blocks:
+                    if old_num not in self.dirty or old_num in self.data:
+                        break
+                else:
+                    return
+                old_block = self.blocks.pop(old_num)
+                if old_num in self.data:
+                    disktools.write_block(old_num, old_block)
+                    self.dirty.discard(old_num)
+                    self.data.discard(old_num)
+                continue
+            old_num, old_block = self.blocks.popitem(last=False)
+            if old_num in self.dirty:
+                disktools.write_block(old_num, old_block)
+                self.dirty.discard(old_num)
+                self.data.discard(old_num)
+
+    def attach_journal(self, journal, reserved=0):
+        '''Commits every later flush through journal, keeping reserved of
+            its blocks for what the commit hooks write.
+        '''
+        with self.lock:
+            self.journal = journal
+            self.journal_reserved = reserved
+
+    def journal_room(self):
+        #journal blocks left for more transactions. Everything dirty is
+        #journaled except file data, which goes home before the commit.
+        #Freed blocks count as well, since they are journaled if they are
+        #allocated again before the commit
+        return self.journal.capacity - self.journal_reserved - (len(self.dirty) - len(self.data))
+
+    def begin(self):
+        '''Starts a transaction once the journal has room for it next to
+            the running ones, committing first if nothing else is running.
+        '''
+        while True:
+            with self.lock:
+                while self.committing:
+                    self.idle.wait()
+                if self.journal is None or self.journal_room() >= (self.active + 1) * TRANSACTION_BLOCKS or \
+                        not (self.active or self.dirty):
+                    self.active += 1
+                    return
+                if self.active:
+                    self.idle.wait()
+                    continue
+            self.flush()
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            #wakes up a commit or a transaction waiting for room
+            self.idle.notify_all()
+            #commit once half the journal's room is taken, or before the cache
+            #fills up with dirty metadata, which it can't evict. File data
+            #is evicted on its own
+            metadata = len(self.dirty) - len(self.data) - len(self.discarded)
+            full = self.journal is not None and (
+                self.journal_room() < (self.journal.capacity - self.journal_reserved) // 2 or
+                metadata >= self.capacity // 2)
+        if full:
+            self.flush()
+
+    @contextmanager
+    def transaction(self):
+        '''Groups the changes made inside the block into one atomic update.'''
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    def flush(self):
+        '''Writes every dirty block back to the disk image. With a journal
+            this waits for running transactions and commits everything
+            they changed at once. Callers that arrive while another commit
+            is being written share the next one.
+        '''
+        wanted = self.commits + 1
+        with self.commit_lock:
+            if self.commits >= wanted:
+                return
+            with self.lock:
+                self.committing = True
+                try:
+                    while self.active:
+                        self.idle.wait()
+                    self.commits += 1
+                    for hook in flush_hooks:
+                        hook()
+                    self.commit()
+                finally:
+                    self.committing = False
+                    self.idle.notify_all()
+
+    def commit(self):
+        #the commit hooks first, then every dirty block as one transaction
+        for hook in commit_hooks:
+            hook()
+        blocks = {n: self.blocks[n] for n in self.dirty if n not in self.discarded}
+        if self.journal is None:
+            disktools.write_blocks(blocks)
+            disktools.discard_blocks(self.discarded)
+            disktools.flush()
+        elif self.dirty:
+            self.journal.commit(blocks, self.data, self.discarded)
+        self.dirty.clear()
+        self.data.clear()
+        self.discarded.clear()
+
+    def checkpoint(self):
+        '''Commits what the running flush has changed so far if the journal
+            has less room left than one transaction may use. Flush hooks
+            call this between changes that are complete on their own.
+        '''
+        with self.lock:
+            if self.committing and self.journal is not None and self.journal_room() < TRANSACTION_BLOCKS:
+                self.commit()
+
+    def sync(self):
+        '''Writes every dirty block back and waits for it to reach the disk.'''
+        self.flush()
+        disktools.fsync()
+
+    def drop(self):
+        '''Forgets every cached block, including unwritten ones.'''
+        with self.lock:
+            self.blocks.clear()
+            self.dirty.clear()
+            self.data.clear()
+            self.discarded.clear()
+
+    def start_writeback(self, interval=DEFAULT_WRITEBACK_INTERVAL):
+        '''Flushes dirty blocks every interval seconds on a background thread.'''
+        self.stop_writeback()
+        self.writeback_stop = threading.Event()
+        stop = self.writeback_stop
+        def writeback():
+            while not stop.wait(interval):
+                self.flush()
+        self.writeback_thread = threading.Thread(target=writeback, name="writeback", daemon=True)
+        self.writeback_thread.start()
+
+    def stop_writeback(self):
+        '''Stops the writeback timer, waiting for a flush it is running.'''
+        if self.writeback_stop is not None:
+            self.writeback_stop.set()
+            self.writeback_stop = None
+            if self.writeback_thread is not threading.current_thread():
+                self.writeback_thread.join()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                capacity=self.capacity,
+                cached=len(self.blocks),
+                dirty=len(self.dirty),
+                hits=self.hits,
+                misses=self.misses,
+                prefetched=self.prefetched,
+                commits=self.commits
+            )
+
+_cache = BufferCache()
+
+def get_cache():
+    return _cache
+
+def configure(capacity=DEFAULT_CAPACITY):
+    '''Replaces the block cache, writing back anything still dirty.'''
+    global _cache
+    _cache.stop_writeback()
+    _cache.flush()
+    _cache = BufferCache(capacity)
+    return _cache
+
+def register_flush_hook(hook):
+    '''Calls hook at the start of every flush. Hooks may allocate blocks,
+        and should call checkpoint() between the changes they make.
+    '''
+    flush_hooks.append(hook)
+
+def register_commit_hook(hook):
+    '''Calls hook before every commit, including those checkpoint() makes.'''
+    commit_hooks.append(hook)
+
+def read_block(block_num):
+    return _cache.read_block(block_num)
+
+def write_block(block_num, data, metadata=True):
+    _cache.write_block(block_num, data, metadata)
+
+def read_blocks(block_nums):
+    return _cache.read_blocks(block_nums)
+
+def write_blocks(blocks, metadata=True):
+    _cache.write_blocks(blocks, metadata)
+
+def discard_blocks(block_nums):
+    _cache.discard_blocks(block_nums)
+
+def prefetch(block_nums):
+    _cache.prefetch(block_nums)
+
+def transaction():
+    return _cache.transaction()
+
+def stats():
+    return _cache.stats()
+
+def checkpoint():
+    _cache.checkpoint()
+
+def flush():
+    _cache.flush()
+
+def sync():
+    _cache.sync()
+
+def close():
+    '''Writes everything back and closes the disk image.'''
+    _cache.stop_writeback()
+    _cache.flush()
+    _cache.drop()
+    _cache.attach_journal(None)
+    disktools.close_device()
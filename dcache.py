@@ -0,0 +1,47 @@
+# Beverley Sun
+# bsun448
+
+import threading
+from collections import OrderedDict
+
+DEFAULT_CAPACITY = 4096
+
+class DentryCache(object):
+    '''Maps absolute paths to the block number of their inode.
+        A block number of None is a negative entry: the path is known not to
+        exist. Entries are evicted least recently used first.
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, path):
+        '''Return: (found, block_num) where block_num is None for a negative entry.'''
+        with self.lock:
+            if path not in self.entries:
+                return False, None
+            self.entries.move_to_end(path)
+            return True, self.entries[path]
+
+    def add(self, path, block_num):
+        with self.lock:
+            self.entries[path] = block_num
+            self.entries.move_to_end(path)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def add_negative(self, path):
+        self.add(path, None)
+
+    def invalidate(self, path):
+        '''Forgets path and everything cached underneath it.'''
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            self.entries.pop(path, None)
+            for cached_path in [p for p in self.entries if p.startswith(prefix)]:
+                del self.entries[cached_path]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Beverley Sun
+# bsun448
+
+'''Defragments a disk image. Every file whose data is in more than one run
+    of blocks is moved into a single run with small.defragment(), in small
+    transactions, so a crash part way through leaves the image consistent.
+
+    An unmounted image is opened directly. A mounted one is defragmented
+    online with --mount, through the mount: setting small.DEFRAG_XATTR on a
+    file makes the running file system defragment it, while other programs
+    keep using the file.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+from stat import S_ISDIR, S_ISREG
+
+import cache
+import disktools
+import small
+
+def walk(fs, path="/"):
+    '''Yield: the path and attributes of every file under path.'''
+    for name, attrs, _ in fs('readdir', path, 0):
+        if name in ('.', '..'):
+            continue
+        child = path.rstrip("/") + "/" + name
+        if S_ISDIR(attrs['st_mode']):
+            for found in walk(fs, child):
+                yield found
+        elif S_ISREG(attrs['st_mode']):
+            yield child, attrs
+
+def defrag_image(name=disktools.DISK_NAME, min_extents=2, verbose=False):
+    '''Return: (files moved, blocks moved).'''
+    fs = small.Small(name)
+    files = blocks = 0
+    try:
+        for path, attrs in list(walk(fs)):
+            with small.locked_inode(path) as open_file:
+                extents = small.count_extents([block_num for _, block_num in small.file_blocks(open_file)])
+            if extents < min_extents:
+                continue
+            try:
+                moved = small.defragment(path)
+            except OSError as e:
+                print('%s: %s' % (path, e), file=sys.stderr)
+                continue
+            if moved:
+                files += 1
+                blocks += moved
+                if verbose:
+                    print('%s: %d extents, moved %d blocks' % (path, extents, moved))
+            elif verbose:
+                print('%s: %d extents, no free run is long enough' % (path, extents))
+    finally:
+        fs('destroy', '/')
+    return files, blocks
+
+def defrag_mount(mount, verbose=False):
+    '''Asks the file system mounted at mount to defragment every file.
+        Files already in one run are left as they are.
+        Return: the number of files asked.
+    '''
+    files = 0
+    for dir_path, _, names in os.walk(mount):
+        for name in names:
+            path = os.path.join(dir_path, name)
+            try:
+                os.setxattr(path, small.DEFRAG_XATTR, b"")
+            except OSError as e:
+                print('%s: %s' % (path, e), file=sys.stderr)
+                continue
+            files += 1
+            if verbose:
+                print('%s: defragmented' % path)
+    return files
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--disk', default=disktools.DISK_NAME)
+    parser.add_argument('--mount', default=None, help='defragment the image mounted here instead, online')
+    parser.add_argument('--cache-blocks', type=int, default=cache.DEFAULT_CAPACITY)
+    parser.add_argument('--min-extents', type=int, default=2, help='only move files in at least this many runs')
+    parser.add_argument('--verbose', action='store_true', help='print every file that is looked at')
+    args = parser.parse_args()
+
+    if args.mount is not None:
+        print('defragmented %d files' % defrag_mount(args.mount, args.verbose))
+    else:
+        cache.configure(args.cache_blocks)
+        files, blocks = defrag_image(args.disk, args.min_extents, args.verbose)
+        print('moved %d blocks of %d files' % (blocks, files))
@@ -0,0 +1,189 @@
+# Beverley Sun
+# bsun448
+
+import os
+import zlib
+from errno import EIO, ENAMETOOLONG, ENOENT, ENOSPC
+from byte_locations import *
+from cache import read_block, write_block
+from bitmap import num_avail_blocks
+from blockmap import NO_BLOCK
+
+def encode_name(name):
+    encoded = bytes(name, STR_ENCODING)
+    if len(encoded) > DIRENT_NAME_END - DIRENT_NAME_START:
+        raise OSError(ENAMETOOLONG, os.strerror(ENAMETOOLONG))
+    return encoded
+
+def name_hash(encoded_name):
+    #zlib.crc32 rather than hash() so buckets are the same in every process
+    return zlib.crc32(encoded_name)
+
+#bucket splits one insert may make, so what adding a name writes stays well
+#inside cache.TRANSACTION_BLOCKS
+MAX_SPLITS = 8
+
+def plan_buckets(entries, entries_per_block):
+    '''Return: {bucket: [(encoded name, location)]} for a new directory of
+        entries, split the way adding them one at a time would split it.
+    '''
+    buckets = {}
+    pending = [(0, 0, list(entries))] if entries else []
+    while pending:
+        bucket, depth, bucket_entries = pending.pop()
+        if len(bucket_entries) <= entries_per_block:
+            buckets[bucket] = bucket_entries
+            continue
+        if depth >= 32:
+            raise OSError(ENOSPC, os.strerror(ENOSPC)) #more names with one hash than fit in a bucket
+        pending.append((bucket, depth + 1, [e for e in bucket_entries if not name_hash(e[0]) >> depth & 1]))
+        pending.append((bucket + (1 << depth), depth + 1, [e for e in bucket_entries if name_hash(e[0]) >> depth & 1]))
+    return buckets
+
+class DirectoryIndex(object):
+    '''Hashed directories, using extendible hashing. A directory's data
+        blocks are buckets of fixed-size name -> inode entries. Bucket i with
+        local depth d holds the names whose hash ends in the d low bits of i,
+        and when it fills up it splits into buckets i and i + 2**d, one bit
+        deeper each. Buckets that have not been split off are holes in the
+        directory, so the bucket of a name is the first one that exists out
+        of hash % 2**d, counting d down from the deepest. Adding a name only
+        writes the buckets of its split, and the directory's size ends at its
+        last bucket.
+    '''
+    def __init__(self, block_map):
+        self.block_map = block_map
+        self.block_size = block_map.block_size
+        self.entries_per_block = self.block_size // DIRENT_SIZE
+
+    def num_buckets(self, dir_inode):
+        #including the holes of buckets not split off yet
+        return dir_inode.size // self.block_size
+
+    def find_bucket(self, dir_inode, hashed):
+        '''Return: (bucket, block num) of the bucket for names with hash
+            hashed, or (None, NO_BLOCK) if the directory has no buckets.
+        '''
+        buckets = self.num_buckets(dir_inode)
+        for depth in range((buckets - 1).bit_length() if buckets else -1, -1, -1):
+            bucket = hashed & ((1 << depth) - 1)
+            if bucket < buckets:
+                block_num = self.block_map.lookup(dir_inode.block, bucket)
+                if block_num != NO_BLOCK:
+                    return bucket, block_num
+        if buckets:
+            raise OSError(EIO, os.strerror(EIO)) #the first bucket is never a hole
+        return None, NO_BLOCK
+
+    def local_depth(self, dir_inode, bucket):
+        #bucket has been split at every depth from its own bit length up to this one
+        buckets = self.num_buckets(dir_inode)
+        depth = bucket.bit_length()
+        while bucket + (1 << depth) < buckets and \
+                self.block_map.lookup(dir_inode.block, bucket + (1 << depth)) != NO_BLOCK:
+            depth += 1
+        return depth
+
+    def bucket_entries(self, bucket_block):
+        #yield (slot, encoded name, inode block) for every used slot
+        for slot in range(self.entries_per_block):
+            start = slot * DIRENT_SIZE
+            location = int.from_bytes(bucket_block[start+DIRENT_INODE_START:start+DIRENT_INODE_END], BYTEORDER)
+            if location != NO_BLOCK:
+                name_len = bucket_block[start+DIRENT_NAME_LEN]
+                name_start = start + DIRENT_NAME_START
+                yield slot, bytes(bucket_block[name_start:name_start+name_len]), location
+
+    def set_entry(self, bucket_block, slot, encoded_name, location):
+        start = slot * DIRENT_SIZE
+        bucket_block[start:start+DIRENT_SIZE] = bytes(DIRENT_SIZE)
+        if location != NO_BLOCK:
+            bucket_block[start+DIRENT_INODE_START:start+DIRENT_INODE_END] = location.to_bytes(PTR_SIZE, BYTEORDER)
+            bucket_block[start+DIRENT_NAME_LEN] = len(encoded_name)
+            bucket_block[start+DIRENT_NAME_START:start+DIRENT_NAME_START+len(encoded_name)] = encoded_name
+
+    def lookup(self, dir_inode, name):
+        '''Return: the inode block of name in the directory, or None.'''
+        encoded_name = encode_name(name)
+        _, bucket_block_num = self.find_bucket(dir_inode, name_hash(encoded_name))
+        if bucket_block_num == NO_BLOCK:
+            return None
+        for _, entry_name, location in self.bucket_entries(read_block(bucket_block_num)):
+            if entry_name == encoded_name:
+                return location
+        return None
+
+    def entries(self, dir_inode):
+        '''Yield: (name, inode block) for every entry, one bucket read at a time.'''
+        for bucket in range(self.num_buckets(dir_inode)):
+            bucket_block_num = self.block_map.lookup(dir_inode.block, bucket)
+            if bucket_block_num == NO_BLOCK:
+                continue
+            for _, entry_name, location in self.bucket_entries(read_block(bucket_block_num)):
+                yield entry_name.decode(STR_ENCODING), location
+
+    def add(self, dir_inode, name, location):
+        '''Adds an entry, updating only its bucket unless that has to split.
+            dir_inode is updated in place and left for the caller to write.
+        '''
+        encoded_name = encode_name(name)
+        hashed = name_hash(encoded_name)
+        bucket, bucket_block_num = self.find_bucket(dir_inode, hashed)
+        if bucket is None:
+            self.write_buckets(dir_inode, {0: [(encoded_name, location)]})
+            return
+        bucket_block = read_block(bucket_block_num)
+        used = list(self.bucket_entries(bucket_block))
+        if len(used) < self.entries_per_block:
+            slots = set(slot for slot, _, _ in used)
+            slot = next(slot for slot in range(self.entries_per_block) if slot not in slots)
+            self.set_entry(bucket_block, slot, encoded_name, location)
+            write_block(bucket_block_num, bucket_block)
+            return
+
+        #split the full bucket, and again while the half the name goes to is
+        #still full, working out every bucket before writing any of them
+        entries = [(entry_name, entry_location) for _, entry_name, entry_location in used]
+        entries.append((encoded_name, location))
+        depth = self.local_depth(dir_inode, bucket)
+        buckets = {}
+        while len(entries) > self.entries_per_block:
+            new_bucket = bucket + (1 << depth)
+            if len(buckets) >= MAX_SPLITS or new_bucket >= self.block_map.max_blocks:
+                raise OSError(ENOSPC, os.strerror(ENOSPC))
+            stay = [entry for entry in entries if not name_hash(entry[0]) >> depth & 1]
+            moved = [entry for entry in entries if name_hash(entry[0]) >> depth & 1]
+            if hashed >> depth & 1:
+                buckets[bucket] = stay
+                bucket, entries = new_bucket, moved
+            else:
+                buckets[new_bucket] = moved
+                entries = stay
+            depth += 1
+        buckets[bucket] = entries
+        if self.block_map.count_unmapped_indexes(dir_inode.block, buckets) > num_avail_blocks():
+            raise OSError(ENOSPC, os.strerror(ENOSPC))
+        self.write_buckets(dir_inode, buckets)
+
+    def write_buckets(self, dir_inode, buckets):
+        #write {bucket: entries} as whole buckets, mapping the new ones
+        for bucket, entries in buckets.items():
+            bucket_block_num, _ = self.block_map.map_block(dir_inode.block, bucket)
+            bucket_block = bytearray(self.block_size)
+            for slot, (entry_name, location) in enumerate(entries):
+                self.set_entry(bucket_block, slot, entry_name, location)
+            write_block(bucket_block_num, bucket_block)
+        dir_inode.size = max(dir_inode.size, (max(buckets) + 1) * self.block_size)
+
+    def remove(self, dir_inode, name):
+        '''Removes an entry, rewriting only its bucket.'''
+        encoded_name = encode_name(name)
+        _, bucket_block_num = self.find_bucket(dir_inode, name_hash(encoded_name))
+        if bucket_block_num != NO_BLOCK:
+            bucket_block = read_block(bucket_block_num)
+            for slot, entry_name, _ in self.bucket_entries(bucket_block):
+                if entry_name == encoded_name:
+                    self.set_entry(bucket_block, slot, b"", NO_BLOCK)
+                    write_block(bucket_block_num, bucket_block)
+                    return
+        raise OSError(ENOENT, os.strerror(ENOENT))
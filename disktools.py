@@ -1,44 +1,250 @@
 from __future__ import print_function, division
 import io
+import mmap
 import os
 
-NUM_BLOCKS = 16
-BLOCK_SIZE = 64
+NUM_BLOCKS = 2048
+BLOCK_SIZE = 512
 DISK_NAME = 'my-disk'
 
-def low_level_format():
-    '''Creates the file system space on disk.
+class BlockDevice(object):
+    '''A disk image that stays open and memory-mapped for a whole mount.
+        Writes land in the mapping straight away but only reach stable
+        storage on flush() (msync) or fsync().
+    '''
+    def __init__(self, name=DISK_NAME, block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS):
+        self.name = name
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.file = open(name, 'r+b')
+        size = block_size * num_blocks
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.close()
+            raise IOError('Disk image is smaller than the file system')
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.map)
+        self.reads = 0 #blocks read and written, for benchmarks
+        self.writes = 0
+        self.syncs = 0
+        self.discards = 0
+
+    def check_block_num(self, block_num):
+        if block_num < 0 or block_num >= self.num_blocks:
+            raise IOError('Block number out of range')
+
+    def read_block(self, block_num):
+        '''Return: a bytearray copy of block_num.'''
+        self.check_block_num(block_num)
+        self.reads += 1
+        start = block_num * self.block_size
+        return bytearray(self.view[start:start + self.block_size])
+
+    def view_block(self, block_num):
+        '''Return: a zero-copy memoryview of block_num.
+            The view is only valid until the device is closed and writes
+            through it bypass write_block.
+        '''
+        self.check_block_num(block_num)
+        start = block_num * self.block_size
+        return self.view[start:start + self.block_size]
+
+    def write_block(self, block_num, data):
+        '''Writes data to the start of block_num.'''
+        self.check_block_num(block_num)
+        if len(data) > self.block_size:
+            raise IOError('Data is larger than a block')
+        self.writes += 1
+        start = block_num * self.block_size
+        self.view[start:start + len(data)] = data
+
+    def read_blocks(self, block_nums):
+        '''Return: {block num: bytearray copy} of every block in block_nums.
+            Adjacent blocks are copied out of the mapping in one go.
+        '''
+        blocks = {}
+        for start, count in runs(block_nums):
+            self.check_block_num(start)
+            self.check_block_num(start + count - 1)
+            data = self.view[start * self.block_size:(start + count) * self.block_size]
+            for i in range(count):
+                blocks[start + i] = bytearray(data[i * self.block_size:(i + 1) * self.block_size])
+            self.reads += count
+        return blocks
+
+    def write_blocks(self, blocks):
+        '''Writes {block num: whole block} with one copy into the mapping for
+            each run of adjacent blocks.
+        '''
+        for start, count in runs(blocks):
+            self.check_block_num(start)
+            self.check_block_num(start + count - 1)
+            if any(len(blocks[start + i]) != self.block_size for i in range(count)):
+                raise IOError('write_blocks needs whole blocks')
+            data = blocks[start] if count == 1 else b"".join(blocks[start + i] for i in range(count))
+            self.view[start * self.block_size:(start + count) * self.block_size] = data
+            self.writes += count
+
+    def discard_blocks(self, block_nums):
+        '''Gives back the space of the blocks in block_nums, which no longer
+            hold anything. Whole pages inside a run of adjacent blocks are
+            punched out of the image. The rest is left as it is, so
+            discarding never writes.
+        '''
+        for start, count in runs(block_nums):
+            self.check_block_num(start)
+            self.check_block_num(start + count - 1)
+            page_begin = -(-start * self.block_size // mmap.PAGESIZE) * mmap.PAGESIZE
+            page_end = (start + count) * self.block_size // mmap.PAGESIZE * mmap.PAGESIZE
+            if page_end > page_begin:
+                punch_hole(self.map, page_begin, page_end - page_begin)
+            self.discards += count
+
+    def will_need(self, block_nums):
+        '''Asks the kernel to start reading the blocks in block_nums.'''
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        for start, count in runs(block_nums):
+            begin = start * self.block_size // mmap.PAGESIZE * mmap.PAGESIZE
+            end = min((start + count) * self.block_size, len(self.map))
+            try:
+                self.map.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+            except OSError:
+                return
+
+    def flush(self):
+        '''Schedules every change made through the mapping to be written.'''
+        self.map.flush()
+
+    def fsync(self):
+        '''Waits until every change is on stable storage.'''
+        self.syncs += 1
+        self.map.flush()
+        os.fsync(self.file.fileno())
+
+    def stats(self):
+        return dict(reads=self.reads, writes=self.writes, syncs=self.syncs, discards=self.discards)
+
+    def close(self):
+        self.flush()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+def runs(block_nums):
+    '''Return: (start, count) of each run of adjacent block numbers, sorted.'''
+    found = []
+    for block_num in sorted(block_nums):
+        if found and found[-1][0] + found[-1][1] == block_num:
+            found[-1][1] += 1
+        else:
+            found.append([block_num, 1])
+    return [tuple(run) for run in found]
+
+def punch_hole(mapping, start, length):
+    '''Frees the pages from start in the file behind mapping, so they read
+        as zeros. Return: False where that is not supported.
+    '''
+    if not hasattr(mmap, 'MADV_REMOVE'):
+        return False
+    try:
+        mapping.madvise(mmap.MADV_REMOVE, start, length)
+    except OSError:
+        return False
+    return True
+
+_device = None
+
+def open_device(name=DISK_NAME, block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS):
+    '''Opens the disk image used by the module-level block functions,
+        closing any image that was already open.
+    '''
+    global _device
+    close_device()
+    _device = BlockDevice(name, block_size, num_blocks)
+    return _device
+
+def get_device():
+    '''Return: the open BlockDevice, opening the default image if needed.'''
+    if _device is None:
+        open_device()
+    return _device
+
+def close_device():
+    '''Flushes and closes the open disk image, if there is one.'''
+    global _device
+    if _device is not None:
+        _device.close()
+        _device = None
+
+def flush():
+    if _device is not None:
+        _device.flush()
+
+def fsync():
+    if _device is not None:
+        _device.fsync()
+
+def stats():
+    '''Return: block reads, writes, fsyncs and discards of the open disk image.'''
+    if _device is None:
+        return {}
+    return _device.stats()
+
+def low_level_format(name=DISK_NAME, block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS, quick_blocks=None):
+    '''Creates the file system space on disk as a sparse file, so it reads
+        as zeros without any of it being written.
+        With quick_blocks, an existing image is resized instead and only its
+        first quick_blocks blocks are zeroed, leaving old data in the rest.
         Warning: calling this erases any existing data in the file system.
     '''
-    with open(DISK_NAME, 'w+b') as disk:
-        for i in range(NUM_BLOCKS):
-            block = bytearray([0] * BLOCK_SIZE)
-            disk.write(block)
+    close_device()
+    quick = quick_blocks is not None and os.path.exists(name)
+    with open(name, 'r+b' if quick else 'w+b') as disk:
+        disk.truncate(block_size * num_blocks)
+        if quick:
+            disk.write(bytes(block_size * min(quick_blocks, num_blocks)))
         disk.flush()
 
 def read_block(block_num):
     '''Reads block_num block from the file system.
         Return: a bytearray of BLOCK_SIZE
     '''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'rb') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        return bytearray(disk.read(BLOCK_SIZE)) #.encode())
+    return get_device().read_block(block_num)
+
+def view_block(block_num):
+    '''Return: a memoryview of block_num without copying.'''
+    return get_device().view_block(block_num)
 
 def write_block(block_num, data):
     '''Writes data to the block_num block.'''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'r+b') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        disk.write(data)
+    get_device().write_block(block_num, data)
+
+def read_blocks(block_nums):
+    '''Return: {block num: bytearray} of the blocks in block_nums.'''
+    if not block_nums:
+        return {}
+    return get_device().read_blocks(block_nums)
+
+def write_blocks(blocks):
+    '''Writes {block num: whole block}, coalescing adjacent blocks.'''
+    if blocks:
+        get_device().write_blocks(blocks)
+
+def will_need(block_nums):
+    '''Starts reading the blocks in block_nums ahead of time.'''
+    if _device is not None and block_nums:
+        _device.will_need(block_nums)
+
+def discard_blocks(block_nums):
+    '''Gives back the space of the blocks in block_nums.'''
+    if block_nums:
+        get_device().discard_blocks(block_nums)
 
 def print_block(block_num):
     '''Prints block_num block data.'''
     data = read_block(block_num)
     print(
-        'block:', block_num, 
+        'block:', block_num,
         ' length of data:', len(data),
         ' type of data:', type(data) )
     for b in data:
@@ -47,23 +253,13 @@ def print_block(block_num):
 
 def int_to_bytes(value, num_bytes):
     '''Store positive integer value in a big-endian bytearray of num_bytes.'''
-    bytes = bytearray(num_bytes)
-    for i in range(num_bytes - 1, -1, -1):
-        nbyte = value % 256
-        bytes[i] = nbyte
-        value = value // 256
-    return bytes
+    return bytearray(value.to_bytes(num_bytes, 'big'))
 
 def bytes_to_int(bytes):
     '''Convert a big-endian bytearray into a positive integer.'''
-    value = 0
-    for i in bytes[:-1]:
-        value += i
-        value *= 256
-    value += bytes[-1]
-    return value
-        
+    return int.from_bytes(bytes, 'big')
+
 if __name__ == '__main__':
     low_level_format()
     os.system('od --address-radix=x -t x1 -a my-disk')
-    
\ No newline at end of file
+
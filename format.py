@@ -1,38 +1,61 @@
 # Beverley Sun
 # bsun448
 
-from disktools import read_block, write_block, low_level_format, BLOCK_SIZE
-from fuse import fuse_get_context
+from disktools import low_level_format, open_device, BLOCK_SIZE, NUM_BLOCKS, DISK_NAME
+from cache import read_block, write_block
+import cache
 from time import time
 from stat import S_IFDIR
-from byte_locations import *
-from stat import S_IFDIR
-
-END_OF_FILE = 20
-BYTEORDER = "little"
-STR_ENCODING = "utf-8"
+from inode import Inode, write_inode
+from bitmap import Bitmap
+from superblock import Superblock
+from byte_locations import BYTEORDER, STR_ENCODING
 
-def setup_root_dir():
-    now = int(time())
+def setup_superblock(sb):
     block = read_block(0)
-    block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END] = (END_OF_FILE).to_bytes(1, BYTEORDER)
-    block[MODE_START:MODE_END] = (S_IFDIR | 0o755).to_bytes(2, BYTEORDER)
-    block[UID_START:UID_END] = fuse_get_context()[0].to_bytes(2, BYTEORDER)
-    block[GID_START:GID_END] = fuse_get_context()[1].to_bytes(2, BYTEORDER)
-    block[NLINKS_START:NLINKS_END] = (2).to_bytes(1, BYTEORDER)
-    block[SIZE_START:SIZE_END] = BLOCK_SIZE.to_bytes(2, BYTEORDER)
-    block[CTIME_START:CTIME_END] = now.to_bytes(4, BYTEORDER)
-    block[MTIME_START:MTIME_END] = now.to_bytes(4, BYTEORDER)
-    block[ATIME_START:ATIME_END] = now.to_bytes(4, BYTEORDER)
-    block[LOCATION_START:LOCATION_END] = (0).to_bytes(1, BYTEORDER)
-    block[NAME_START:NAME_END] = bytes("/", STR_ENCODING)
+    packed = sb.pack()
+    block[0:len(packed)] = packed
     write_block(0, block)
 
-def setup_bitmap():
-    with open("bitmap", "w") as bitmap:
-        bitmap.write(bin(2**15))
-                
+def setup_root_dir(sb, owner=None):
+    #owner is (uid, gid), by default the calling process. fuse is only
+    #needed for that, so images can be built where libfuse is missing
+    if owner is None:
+        from fuse import fuse_get_context
+        owner = fuse_get_context()[:2]
+    uid, gid = owner
+    write_inode(Inode.new(sb.block_size, sb.root_block, S_IFDIR | 0o755, 2, uid, gid, int(time())))
+
+def setup_bitmap(sb):
+    bitmap = Bitmap(sb.num_blocks, sb.block_size, sb.bitmap_start)
+    bitmap.format(sb.root_block + 1)
+    bitmap.flush()
+
+def format_disk(name=DISK_NAME, block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS, journal_blocks=None, quick=False,
+        owner=None):
+    '''Makes an empty file system in name. A quick format only clears the
+        metadata (superblock, bitmap, journal and root directory) of an
+        existing image, which is enough because nothing reads a block
+        before it has been allocated and written. The root directory
+        belongs to owner, (uid, gid), or else to the calling process.
+    '''
+    sb = Superblock(block_size, num_blocks, journal_blocks=journal_blocks).check()
+    low_level_format(name, block_size, num_blocks, sb.root_block + 1 if quick else None)
+    open_device(name, block_size, num_blocks)
+    setup_superblock(sb)
+    setup_bitmap(sb)
+    setup_root_dir(sb, owner)
+    cache.close()
+    return sb
+
 if __name__ == "__main__":
-    low_level_format()
-    setup_root_dir()
-    setup_bitmap()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    parser.add_argument('--journal-blocks', type=int, default=None)
+    parser.add_argument('--disk', default=DISK_NAME)
+    parser.add_argument('--quick', action='store_true', help='reuse an existing image, clearing only the metadata')
+    args = parser.parse_args()
+
+    format_disk(args.disk, args.block_size, args.num_blocks, args.journal_blocks, args.quick)
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+
+# Beverley Sun
+# bsun448
+
+'''Checks a disk image offline. The whole image is mapped as one NumPy
+    array of blocks laid out as in byte_locations.py, so each check runs
+    over every inode, block pointer or directory entry at once instead of
+    reading blocks one at a time. With --repair the bitmap is rebuilt from
+    the blocks that are reachable from the root, link counts are fixed,
+    entries that point nowhere are removed and orphaned inodes (files that
+    were unlinked while open when the image was last unmounted) are reclaimed.
+'''
+
+from __future__ import print_function, division
+
+import os
+import sys
+from stat import S_IFDIR, S_IFMT, S_IFREG
+from time import perf_counter
+
+import numpy as np
+
+import disktools
+from byte_locations import *
+from superblock import read_superblock
+from journal import Journal, HEADER_STRUCT, HOME_STRUCT, JOURNAL_MAGIC
+from blockmap import BlockMap
+from directory import name_hash
+
+#exit codes, as used by e2fsck
+CLEAN = 0
+REPAIRED = 1
+UNREPAIRED = 4
+FAILED = 8
+
+#problems are printed with at most this many example block numbers
+EXAMPLES = 8
+
+#the file type bits of a mode, S_IFMT() for whole arrays
+TYPE_BITS = S_IFMT(0o777777)
+
+def block_dtype(block_size):
+    '''Return: a structured dtype of one block, with the inode fields, the
+        block map, indirect block pointers and directory entries overlaid.
+    '''
+    dirent = np.dtype({
+        'names': ['inode', 'name_len', 'name'],
+        'formats': ['<u4', 'u1', 'S%d' % (DIRENT_NAME_END - DIRENT_NAME_START)],
+        'offsets': [DIRENT_INODE_START, DIRENT_NAME_LEN, DIRENT_NAME_START],
+        'itemsize': DIRENT_SIZE
+    })
+    return np.dtype({
+        'names': ['mode', 'uid', 'gid', 'nlinks', 'size', 'ctime', 'mtime', 'atime', 'location',
+            'ptrs', 'words', 'dirents', 'raw'],
+        'formats': ['<u2', '<u4', '<u4', '<u4', '<u8', '<u4', '<u4', '<u4', '<u4',
+            ('<u4', (block_size - BLOCKMAP_START) // PTR_SIZE), ('<u4', block_size // PTR_SIZE),
+            (dirent, block_size // DIRENT_SIZE), ('u1', block_size)],
+        'offsets': [MODE_START, UID_START, GID_START, NLINKS_START, SIZE_START, CTIME_START,
+            MTIME_START, ATIME_START, LOCATION_START, BLOCKMAP_START, 0, 0, 0],
+        'itemsize': block_size
+    })
+
+def bit_length(values):
+    #int.bit_length for every value in an array of non-negative ints
+    return np.where(values > 0, np.floor(np.log2(np.maximum(values, 1))).astype(np.int64) + 1, 0)
+
+def examples(values):
+    shown = ', '.join(str(int(v)) for v in values[:EXAMPLES])
+    return shown + (', ...' if len(values) > EXAMPLES else '')
+
+class Fsck(object):
+    '''One check of the image name. check() finds the problems and, with
+        repair, fixes those it can. Problems and statistics are kept in
+        problems and stats for report().
+    '''
+    def __init__(self, name=disktools.DISK_NAME, repair=False):
+        self.name = name
+        self.repair = repair
+        self.sb = read_superblock(name)
+        self.block_size = self.sb.block_size
+        self.num_blocks = self.sb.num_blocks
+        self.block_map = BlockMap(self.block_size)
+        if os.path.getsize(name) < self.block_size * self.num_blocks:
+            raise IOError('Disk image is smaller than the file system')
+        self.replayed = 0
+        if repair:
+            self.replayed = self.replay_journal()
+        self.image = np.memmap(name, block_dtype(self.block_size), 'r+' if repair else 'r',
+            shape=(self.num_blocks,))
+        self.problems = [] #(message, repaired)
+        self.notes = []
+        self.stats = {}
+
+    def replay_journal(self):
+        #the committed state is what a mount would see
+        disktools.open_device(self.name, self.block_size, self.num_blocks)
+        try:
+            return Journal(self.sb.journal_start, self.sb.journal_blocks, self.block_size).replay()
+        finally:
+            disktools.close_device()
+
+    def problem(self, message, repaired=False):
+        self.problems.append((message, repaired and self.repair))
+
+    def check(self):
+        start = perf_counter()
+        self.check_journal()
+        if not self.check_root():
+            return self
+        self.walk()
+        self.check_sizes()
+        self.check_references()
+        self.check_bitmap()
+        self.fragmentation()
+        if self.repair:
+            self.image.flush()
+        self.stats['seconds'] = perf_counter() - start
+        return self
+
+    def check_journal(self):
+        if self.replayed:
+            self.notes.append('replayed %d blocks from the journal' % self.replayed)
+        elif not self.repair and self.committed():
+            self.notes.append('the journal holds a committed transaction, which mounting '
+                'or --repair replays; this check is of the image before it')
+
+    def committed(self):
+        #the same test as Journal.replay(), without writing anything
+        journal = Journal(self.sb.journal_start, self.sb.journal_blocks, self.block_size)
+        raw = self.image['raw']
+        magic, sequence, count, crc = HEADER_STRUCT.unpack_from(raw[journal.start_block].tobytes())
+        if magic != JOURNAL_MAGIC or count == 0 or count > journal.capacity:
+            return False
+        first_image = journal.start_block + journal.descriptor_blocks(count)
+        descriptor = raw[journal.start_block:first_image].tobytes()
+        homes = descriptor[HEADER_STRUCT.size:HEADER_STRUCT.size + count * HOME_STRUCT.size]
+        images = [raw[first_image + i].tobytes() for i in range(count)]
+        return journal.checksum(sequence, homes, images) == crc
+
+    def is_inode(self):
+        #an inode records its own block number and is a file or a directory
+        locations = np.asarray(self.image['location'])
+        kinds = np.asarray(self.image['mode']) & TYPE_BITS
+        inode = (locations == np.arange(self.num_blocks)) & ((kinds == S_IFREG) | (kinds == S_IFDIR))
+        inode[:self.sb.root_block] = False
+        return inode
+
+    def check_root(self):
+        root = self.sb.root_block
+        self.inode = self.is_inode()
+        if not self.inode[root] or S_IFMT(int(self.image['mode'][root])) != S_IFDIR:
+            self.problem('the root directory in block %d is not a directory inode' % root)
+            return False
+        return True
+
+    def follow(self, owners, holders, field, first, last, what):
+        '''Reads the pointers in slots first..last-1 of field in each of the
+            holder blocks, which belong to the inodes in owners. Pointers
+            outside the data area are reported, and cleared when repairing
+            so they read as holes.
+            Return: (row, slot, block) arrays of the pointers that are not holes.
+        '''
+        ptrs = self.image[field][holders][:, first:last]
+        rows, slots = np.nonzero(ptrs)
+        blocks = ptrs[rows, slots].astype(np.int64)
+        ok = (blocks > self.sb.root_block) & (blocks < self.num_blocks)
+        if not ok.all():
+            bad = ~ok
+            self.problem('%d %s pointers out of range, in inodes %s' % (
+                bad.sum(), what, examples(np.unique(owners[rows[bad]]))), repaired=True)
+            if self.repair:
+                self.image[field][holders[rows[bad]], first + slots[bad]] = 0
+        return rows[ok], slots[ok], blocks[ok]
+
+    def map_blocks(self, inodes):
+        '''Return: (owner, index, block) arrays of every block mapped by the
+            given inodes, and (owner, block) arrays of their indirect blocks.
+        '''
+        num_direct, per_block = self.block_map.num_direct, self.block_map.ptrs_per_block
+        single_slot, double_slot = self.block_map.indirect_slot, self.block_map.double_indirect_slot
+
+        rows, index, blocks = self.follow(inodes, inodes, 'ptrs', 0, num_direct, 'data')
+        data = [(inodes[rows], index, blocks)]
+
+        rows, _, single = self.follow(inodes, inodes, 'ptrs', single_slot, single_slot + 1, 'indirect')
+        single_owners = inodes[rows]
+        rows, slots, blocks = self.follow(single_owners, single, 'words', 0, per_block, 'data')
+        data.append((single_owners[rows], num_direct + slots, blocks))
+
+        rows, _, double = self.follow(inodes, inodes, 'ptrs', double_slot, double_slot + 1, 'double indirect')
+        double_owners = inodes[rows]
+        rows, outer, middle = self.follow(double_owners, double, 'words', 0, per_block, 'indirect')
+        middle_owners = double_owners[rows]
+        rows, inner, blocks = self.follow(middle_owners, middle, 'words', 0, per_block, 'data')
+        data.append((middle_owners[rows], num_direct + per_block + outer[rows] * per_block + inner, blocks))
+
+        meta = [(single_owners, single), (double_owners, double), (middle_owners, middle)]
+        owner, index, block = (np.concatenate(column).astype(np.int64) for column in zip(*data))
+        meta_owner, meta_block = (np.concatenate(column).astype(np.int64) for column in zip(*meta))
+        return owner, index, block, meta_owner, meta_block
+
+    def walk(self):
+        #breadth first from the root, one directory level per pass
+        root = self.sb.root_block
+        self.reached = np.zeros(self.num_blocks, bool)
+        self.reached[root] = True
+        self.links = np.zeros(self.num_blocks, np.int64) #directory entries naming each inode
+        self.entries = np.zeros(self.num_blocks, np.int64) #valid entries in each directory
+        inodes, data, meta = [], [], []
+        frontier = np.array([root], np.int64)
+        while frontier.size:
+            inodes.append(frontier)
+            owner, index, block, meta_owner, meta_block = self.map_blocks(frontier)
+            data.append((owner, index, block))
+            meta.append((meta_owner, meta_block))
+
+            is_dir = (self.image['mode'][owner] & TYPE_BITS) == S_IFDIR
+            frontier = self.read_entries(owner[is_dir], index[is_dir], block[is_dir])
+
+        self.inodes = np.concatenate(inodes)
+        self.data_owner, self.data_index, self.data_block = (np.concatenate(c) for c in zip(*data))
+        self.meta_owner, self.meta_block = (np.concatenate(c) for c in zip(*meta))
+
+    def read_entries(self, dirs, buckets, blocks):
+        '''Checks the entries in the buckets of directories dirs.
+            Return: the inodes they name that have not been reached before.
+        '''
+        dirents = self.image['dirents'][blocks]
+        rows, slots = np.nonzero(dirents['inode'])
+        parents, children = dirs[rows], dirents['inode'][rows, slots].astype(np.int64)
+
+        #names have to fit and be in the bucket their hash picks
+        masks = (np.int64(1) << self.local_depths(dirs, buckets)) - 1
+        bad = np.zeros(len(rows), bool)
+        misplaced, names = [], set()
+        for i, (row, slot) in enumerate(zip(rows, slots)):
+            entry = dirents[row, slot]
+            name = entry['name'][:entry['name_len']]
+            if not 0 < entry['name_len'] <= DIRENT_NAME_END - DIRENT_NAME_START or len(name) != entry['name_len']:
+                bad[i] = True
+                continue
+            key = (parents[i], name)
+            if key in names:
+                self.problem('directory %d has two entries named %r' % (parents[i], name))
+            names.add(key)
+            if name_hash(name) & int(masks[row]) != buckets[row]:
+                misplaced.append(parents[i])
+        if bad.any():
+            self.problem('%d directory entries with bad names, in directories %s' % (
+                bad.sum(), examples(np.unique(parents[bad]))), repaired=True)
+        if misplaced:
+            self.problem('%d directory entries in the wrong bucket, in directories %s' % (
+                len(misplaced), examples(np.unique(misplaced))))
+
+        in_range = children < self.num_blocks
+        dangling = ~bad & ~(in_range & self.inode[np.where(in_range, children, 0)])
+        if dangling.any():
+            self.problem('%d directory entries point at blocks that are not inodes, in directories %s' % (
+                dangling.sum(), examples(np.unique(parents[dangling]))), repaired=True)
+        drop = bad | dangling
+        if self.repair and drop.any():
+            for row, slot in zip(rows[drop], slots[drop]):
+                start = slot * DIRENT_SIZE
+                self.image['raw'][blocks[row], start:start + DIRENT_SIZE] = 0
+
+        parents, children = parents[~drop], children[~drop]
+        np.add.at(self.entries, parents, 1)
+        np.add.at(self.links, children, 1)
+        linked = np.unique(children)
+        again = linked[self.reached[linked]]
+        if again.size:
+            #Small has no hard links, so this is a loop or a cross-linked inode
+            self.problem('%d inodes are linked from more than one entry: %s' % (again.size, examples(again)))
+        new = linked[~self.reached[linked]]
+        self.reached[new] = True
+        return new
+
+    def local_depths(self, dirs, buckets):
+        '''Return: the local depth of each bucket of directories dirs, given
+            with every bucket those directories have.
+        '''
+        #a bucket has been split at every depth from its bit length while the
+        #bucket split off at that depth exists
+        slots = self.image['size'][dirs].astype(np.int64) // self.block_size
+        span = int(max(slots.max(initial=0), buckets.max(initial=-1) + 1))
+        keys = dirs * span + buckets
+        depths = bit_length(buckets)
+        splitting = np.ones(len(buckets), bool)
+        while splitting.any():
+            split_off = buckets + (np.int64(1) << depths)
+            splitting &= split_off < slots
+            splitting[splitting] = np.isin(dirs[splitting] * span + split_off[splitting], keys)
+            depths[splitting] += 1
+        return depths
+
+    def check_sizes(self):
+        modes = self.image['mode'][self.inodes] & TYPE_BITS
+        sizes = self.image['size'][self.inodes].astype(np.int64)
+        nlinks = self.image['nlinks'][self.inodes].astype(np.int64)
+        dirs, files = self.inodes[modes == S_IFDIR], self.inodes[modes == S_IFREG]
+
+        #a directory's links are its entries plus . and its name in the parent
+        expected = np.where(modes == S_IFDIR, 2 + self.entries[self.inodes], self.links[self.inodes])
+        wrong = nlinks != expected
+        if wrong.any():
+            self.problem('%d inodes with the wrong link count: %s' % (wrong.sum(), examples(self.inodes[wrong])),
+                repaired=True)
+            if self.repair:
+                self.image['nlinks'][self.inodes[wrong]] = expected[wrong]
+
+        #every bucket of a directory was split off one that exists, and the
+        #directory's size ends at its last bucket
+        dir_sizes = sizes[modes == S_IFDIR]
+        slots = dir_sizes // self.block_size
+        in_dir = (self.image['mode'][self.data_owner] & TYPE_BITS) == S_IFDIR
+        owner, index = self.data_owner[in_dir], self.data_index[in_dir]
+        span = int(max(slots.max(initial=0), index.max(initial=-1) + 1))
+        keys = owner * span + index
+        parent = index - np.where(index > 0, np.int64(1) << np.maximum(bit_length(index) - 1, 0), 0)
+        stray = owner[~np.isin(owner * span + parent, keys) |
+            (index >= self.image['size'][owner].astype(np.int64) // self.block_size)]
+        bad = (dir_sizes % self.block_size != 0) | np.isin(dirs, stray)
+        bad |= (slots > 0) & ~np.isin(dirs * span + slots - 1, keys)
+        if bad.any():
+            self.problem('%d directories with a bucket missing or past their size: %s' % (
+                bad.sum(), examples(dirs[bad])))
+
+        #files can have holes, but nothing mapped past the end
+        last = np.full(self.num_blocks, -1, np.int64)
+        np.maximum.at(last, self.data_owner, self.data_index)
+        needed = (last[files] + 1) * self.block_size
+        short = needed > sizes[modes == S_IFREG] + self.block_size - 1
+        if short.any():
+            self.problem('%d files with blocks mapped past their size: %s' % (short.sum(), examples(files[short])),
+                repaired=True)
+            if self.repair:
+                self.image['size'][files[short]] = needed[short]
+
+    def check_references(self):
+        owned = np.concatenate([self.inodes, self.data_block, self.meta_block])
+        counts = np.bincount(owned, minlength=self.num_blocks)
+        shared = np.nonzero(counts > 1)[0]
+        if shared.size:
+            self.problem('%d blocks are used more than once: %s' % (shared.size, examples(shared)))
+        self.used = counts > 0
+        self.used[:self.sb.root_block + 1] = True
+
+        #inodes nothing links to, left by files unlinked while they were open.
+        #Freed blocks are not cleared, so only allocated ones count
+        orphans = np.nonzero(self.inode & ~self.used & self.bitmap_bits()[:self.num_blocks].astype(bool))[0]
+        self.stats['orphans'] = int(orphans.size)
+        if orphans.size:
+            self.problem('%d orphaned inodes: %s' % (orphans.size, examples(orphans)), repaired=True)
+            if self.repair:
+                #their blocks are freed with the rebuilt bitmap
+                self.image['raw'][orphans] = 0
+
+    def bitmap_bits(self):
+        start, count = self.sb.bitmap_start, self.sb.bitmap_blocks
+        return np.unpackbits(np.asarray(self.image['raw'][start:start + count]).ravel())
+
+    def check_bitmap(self):
+        start, count = self.sb.bitmap_start, self.sb.bitmap_blocks
+        bits = self.bitmap_bits()
+        marked = bits[:self.num_blocks].astype(bool)
+        leaked = np.nonzero(marked & ~self.used)[0]
+        missing = np.nonzero(self.used & ~marked)[0]
+        if leaked.size:
+            self.problem('%d blocks are marked used but nothing uses them: %s' % (leaked.size, examples(leaked)),
+                repaired=True)
+        if missing.size:
+            self.problem('%d blocks in use are marked free: %s' % (missing.size, examples(missing)),
+                repaired=True)
+        if self.repair and (leaked.size or missing.size or not bits[self.num_blocks:].all()):
+            #bits past the last block are never free
+            rebuilt = np.ones(len(bits), bool)
+            rebuilt[:self.num_blocks] = self.used
+            self.image['raw'][start:start + count] = np.packbits(rebuilt).reshape(count, self.block_size)
+
+    def fragmentation(self):
+        free = ~self.used
+        files = (self.image['mode'][self.data_owner] & TYPE_BITS) == S_IFREG
+        owner, index, block = self.data_owner[files], self.data_index[files], self.data_block[files]
+
+        #a new extent starts wherever the next file block is not the next disk block
+        order = np.lexsort((index, owner))
+        owner, index, block = owner[order], index[order], block[order]
+        starts = np.ones(len(block), bool)
+        starts[1:] = (owner[1:] != owner[:-1]) | (block[1:] != block[:-1] + 1) | (index[1:] != index[:-1] + 1)
+        with_data, inverse = np.unique(owner, return_inverse=True)
+        extents = np.bincount(inverse, weights=starts).astype(np.int64) if len(owner) else np.zeros(0, np.int64)
+
+        #runs of free blocks
+        edges = np.diff(np.concatenate([[0], free.astype(np.int8), [0]]))
+        runs = np.nonzero(edges == -1)[0] - np.nonzero(edges == 1)[0]
+
+        modes = self.image['mode'][self.inodes] & TYPE_BITS
+        self.stats.update(
+            files=int((modes == S_IFREG).sum()),
+            directories=int((modes == S_IFDIR).sum()),
+            data_blocks=int(len(self.data_block)),
+            indirect_blocks=int(len(self.meta_block)),
+            free_blocks=int(free.sum()),
+            fragmented_files=int((extents > 1).sum()),
+            extents_per_file=float(extents.mean()) if len(extents) else 0.0,
+            most_extents=int(extents.max()) if len(extents) else 0,
+            free_extents=int(len(runs)),
+            largest_free_extent=int(runs.max()) if len(runs) else 0
+        )
+
+    def report(self, out=sys.stdout):
+        for note in self.notes:
+            print('note:', note, file=out)
+        for message, repaired in self.problems:
+            print('%s: %s' % ('repaired' if repaired else 'error', message), file=out)
+        for key in sorted(self.stats):
+            value = self.stats[key]
+            print('%s: %s' % (key.replace('_', ' '), '%.3f' % value if isinstance(value, float) else value), file=out)
+
+    def exit_code(self):
+        if any(not repaired for _, repaired in self.problems):
+            return UNREPAIRED
+        return REPAIRED if self.problems else CLEAN
+
+def check_image(name=disktools.DISK_NAME, repair=False):
+    '''Return: the finished Fsck of the image name.'''
+    return Fsck(name, repair).check()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--disk', default=disktools.DISK_NAME)
+    parser.add_argument('--repair', action='store_true', help='fix the problems that can be fixed')
+    args = parser.parse_args()
+
+    try:
+        fsck = check_image(args.disk, args.repair)
+    except IOError as e:
+        print('fsck:', e, file=sys.stderr)
+        sys.exit(FAILED)
+    fsck.report()
+    sys.exit(fsck.exit_code())
@@ -0,0 +1,52 @@
+# Beverley Sun
+# bsun448
+
+import struct
+from cache import read_block, write_block
+
+#mode, uid, gid, links, size, ctime, mtime, atime, location: the fields
+#from MODE_START up to BLOCKMAP_START in byte_locations.py
+INODE_STRUCT = struct.Struct("<HIIIQIIII")
+
+class Inode(object):
+    '''The fields of an inode, decoded from the start of its block. The
+        block is kept so the block map after the fields goes with it, and
+        pack() encodes the fields back into it.
+    '''
+    __slots__ = ('mode', 'uid', 'gid', 'nlinks', 'size', 'ctime', 'mtime', 'atime', 'location', 'block')
+
+    def __init__(self, block):
+        self.block = block
+        (self.mode, self.uid, self.gid, self.nlinks, self.size,
+            self.ctime, self.mtime, self.atime, self.location) = INODE_STRUCT.unpack_from(block)
+
+    @classmethod
+    def new(cls, block_size, location, mode, nlinks, uid, gid, now):
+        '''Return: an inode in a fresh block with no data.'''
+        block = bytearray(block_size)
+        INODE_STRUCT.pack_into(block, 0, mode, uid, gid, nlinks, 0, now, now, now, location)
+        return cls(block)
+
+    def pack(self):
+        '''Return: the block with the fields encoded into it.'''
+        INODE_STRUCT.pack_into(self.block, 0, self.mode, self.uid, self.gid, self.nlinks, self.size,
+            self.ctime, self.mtime, self.atime, self.location)
+        return self.block
+
+    def stat(self):
+        return dict(
+            st_mode=self.mode,
+            st_ctime=self.ctime,
+            st_mtime=self.mtime,
+            st_atime=self.atime,
+            st_nlink=self.nlinks,
+            st_size=self.size,
+            st_uid=self.uid,
+            st_gid=self.gid
+        )
+
+def read_inode(location):
+    return Inode(read_block(location))
+
+def write_inode(inode):
+    write_block(inode.location, inode.pack())
@@ -0,0 +1,147 @@
+# Beverley Sun
+# bsun448
+
+import struct
+import zlib
+import disktools
+from cache import TRANSACTION_BLOCKS
+from bitmap import bitmap_blocks, freed_blocks, take_freed, is_set
+
+JOURNAL_MAGIC = b"JRNL"
+MAX_JOURNAL_BLOCKS = 1024
+
+#magic, sequence, journaled block count, crc32 of the block numbers and block images
+HEADER_STRUCT = struct.Struct("<4sQII")
+HOME_STRUCT = struct.Struct("<I")
+
+def descriptor_blocks(count, block_size):
+    #the header and the home block number of count journaled blocks
+    return -(-(HEADER_STRUCT.size + count * HOME_STRUCT.size) // block_size)
+
+def min_journal_blocks(bitmap_blocks, block_size, transactions=1):
+    '''Return: the smallest journal that holds transactions of the largest
+        size at once, next to every bitmap block.
+    '''
+    capacity = transactions * TRANSACTION_BLOCKS + bitmap_blocks
+    return capacity + descriptor_blocks(capacity, block_size)
+
+def journal_blocks(num_blocks, block_size):
+    '''Return: the default journal size for a disk of num_blocks, with room
+        for two transactions at least.
+    '''
+    return max(min_journal_blocks(bitmap_blocks(num_blocks, block_size), block_size, 2),
+        min(MAX_JOURNAL_BLOCKS, num_blocks // 32))
+
+class Journal(object):
+    '''Write-ahead journal in the blocks from start_block onwards. A commit
+        writes a descriptor (header and the home block number of every
+        journaled block) followed by the block images, and the crc in the
+        header only matches once all of them are on disk. The blocks are
+        then written home. If the image is mounted after a crash the last
+        complete transaction is written home again.
+
+        Metadata is journaled. File data is written home before the commit
+        (ordered mode), except blocks freed since the last commit, which
+        may still be metadata of the committed state: those are journaled
+        if they were reused and written after the commit if they are free.
+    '''
+    def __init__(self, start_block, num_blocks, block_size):
+        self.start_block = start_block
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.sequence = 0
+        self.capacity = num_blocks - 1
+        while self.capacity + self.descriptor_blocks(self.capacity) > num_blocks:
+            self.capacity -= 1
+
+    def descriptor_blocks(self, count):
+        return descriptor_blocks(count, self.block_size)
+
+    def checksum(self, sequence, descriptor, images):
+        crc = zlib.crc32(HOME_STRUCT.pack(sequence & 0xffffffff))
+        crc = zlib.crc32(descriptor, crc)
+        for image in images:
+            crc = zlib.crc32(image, crc)
+        return crc
+
+    def write_transaction(self, block_nums, blocks):
+        self.sequence += 1
+        homes = b"".join(HOME_STRUCT.pack(block_num) for block_num in block_nums)
+        images = [blocks[block_num] for block_num in block_nums]
+        header = HEADER_STRUCT.pack(JOURNAL_MAGIC, self.sequence, len(block_nums),
+            self.checksum(self.sequence, homes, images))
+
+        #the descriptor and images are one run of blocks, written at once
+        num_descriptor_blocks = self.descriptor_blocks(len(block_nums))
+        descriptor = (header + homes).ljust(num_descriptor_blocks * self.block_size, b"\0")
+        run = {self.start_block + i: descriptor[i*self.block_size:(i+1)*self.block_size]
+            for i in range(num_descriptor_blocks)}
+        for i, image in enumerate(images):
+            run[self.start_block + num_descriptor_blocks + i] = image
+        disktools.write_blocks(run)
+
+    def clear(self):
+        #an empty transaction, keeping the sequence number
+        disktools.write_block(self.start_block, HEADER_STRUCT.pack(JOURNAL_MAGIC, self.sequence, 0, 0))
+
+    def commit(self, blocks, data_block_nums, discarded=()):
+        '''Writes blocks ({block num: image}) home as one transaction, then
+            discards the blocks in discarded that are still free.
+            data_block_nums are the blocks last written as file data.
+        '''
+        freed = freed_blocks()
+        data_first, journaled, free_after = [], [], []
+        for block_num in sorted(blocks):
+            if block_num in freed:
+                (journaled if is_set(block_num) else free_after).append(block_num)
+            elif block_num in data_block_nums:
+                data_first.append(block_num)
+            else:
+                journaled.append(block_num)
+
+        if len(journaled) > self.capacity:
+            #splitting it would not be atomic, so nothing is written
+            raise IOError('A transaction of %d blocks does not fit the %d block journal' % (
+                len(journaled), self.capacity))
+
+        disktools.write_blocks({block_num: blocks[block_num] for block_num in data_first})
+        if journaled:
+            self.write_transaction(journaled, blocks)
+            disktools.fsync()
+            disktools.write_blocks({block_num: blocks[block_num] for block_num in journaled})
+        disktools.write_blocks({block_num: blocks[block_num] for block_num in free_after})
+        disktools.fsync()
+        #only once the commit that freed them is on disk
+        disktools.discard_blocks([block_num for block_num in discarded if not is_set(block_num)])
+        take_freed()
+        if journaled:
+            #replaying a transaction that is already home is harmless, so this
+            #only has to reach the disk with the next sync
+            self.clear()
+
+    def replay(self):
+        '''Writes the last committed transaction home again.
+            Return: the number of blocks replayed.
+        '''
+        header = disktools.read_block(self.start_block)
+        magic, sequence, count, crc = HEADER_STRUCT.unpack_from(header)
+        if magic != JOURNAL_MAGIC:
+            return 0
+        self.sequence = sequence
+        if count == 0 or count > self.capacity:
+            return 0
+        num_descriptor_blocks = self.descriptor_blocks(count)
+        run = disktools.read_blocks(range(self.start_block, self.start_block + num_descriptor_blocks + count))
+        descriptor = b"".join(run[self.start_block + i] for i in range(num_descriptor_blocks))
+        homes = descriptor[HEADER_STRUCT.size:HEADER_STRUCT.size + count * HOME_STRUCT.size]
+        images = [run[self.start_block + num_descriptor_blocks + i] for i in range(count)]
+        if self.checksum(sequence, homes, images) != crc:
+            #the crash happened before the commit was complete
+            return 0
+
+        disktools.write_blocks({block_num: image
+            for (block_num,), image in zip(HOME_STRUCT.iter_unpack(homes), images)})
+        disktools.fsync()
+        self.clear()
+        disktools.fsync()
+        return count
@@ -0,0 +1,111 @@
+# Beverley Sun
+# bsun448
+
+import threading
+from contextlib import contextmanager
+
+class RWLock(object):
+    '''Many readers or one writer. New readers wait while a writer is waiting,
+        so a stream of readers can't starve writers. The thread holding the
+        write lock may take either side again, and a reader may read again.
+        A reader can't upgrade to writing.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None #thread holding the write lock
+        self.write_depth = 0
+        self.waiting_writers = 0
+        self.local = threading.local() #read depth of the current thread
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        depth = getattr(self.local, 'depth', 0)
+        with self.cond:
+            if self.writer is not me and depth == 0:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+            self.readers += 1
+        self.local.depth = depth + 1
+
+    def release_read(self):
+        self.local.depth -= 1
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.write_depth += 1
+                return
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if self.write_depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class LockTable(object):
+    '''An RWLock per key (inode block number), kept only while it is in use.'''
+    def __init__(self):
+        self.locks = {} #key -> [RWLock, users]
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [RWLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def put(self, key):
+        with self.lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    @contextmanager
+    def reading(self, key):
+        rwlock = self.get(key)
+        try:
+            with rwlock.reading():
+                yield
+        finally:
+            self.put(key)
+
+    @contextmanager
+    def writing(self, key):
+        rwlock = self.get(key)
+        try:
+            with rwlock.writing():
+                yield
+        finally:
+            self.put(key)
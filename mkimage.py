@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Beverley Sun
+# bsun448
+
+'''Builds a disk image from a directory on the host without mounting it,
+    or exports an image back into a directory.
+
+    Building plans the whole tree first, so an image that is too small is
+    rejected before anything is written, and then formats the image and
+    lays everything out in one reserved run: each directory's inode and
+    buckets, the inodes of its entries, the data of its files and then its
+    subdirectories. File data is streamed to the image in large batches
+    and everything else is built in the cache and written with one flush.
+    There is no journal to fall back on while building, so an image whose
+    build fails part way should be built again.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+from stat import S_IFDIR, S_IFREG, S_IMODE, S_ISDIR, S_ISREG
+from time import time
+
+import cache
+import disktools
+from format import format_disk
+from superblock import Superblock
+from bitmap import Reservation, load_bitmap, unload_bitmap, reserve, release, allocate_reserved
+from blockmap import BlockMap
+from directory import DirectoryIndex, encode_name, plan_buckets
+from inode import Inode, read_inode, write_inode
+
+#file data written to the image at a time
+BATCH_BLOCKS = 1024
+
+class Entry(object):
+    '''A file or directory found on the host.'''
+    __slots__ = ('name', 'path', 'stat', 'children', 'location')
+
+    def __init__(self, name, path, stat):
+        self.name = name
+        self.path = path
+        self.stat = stat
+        self.children = [] if S_ISDIR(stat.st_mode) else None
+        self.location = None
+
+def scan(path, name=""):
+    '''Return: the Entry for path and everything under it. Anything that is
+        not a regular file or a directory is left out with a warning.
+    '''
+    entry = Entry(name, path, os.lstat(path))
+    for child_name in sorted(os.listdir(path)):
+        child_path = os.path.join(path, child_name)
+        stat = os.lstat(child_path)
+        if S_ISDIR(stat.st_mode):
+            child = scan(child_path, child_name)
+        elif S_ISREG(stat.st_mode):
+            child = Entry(child_name, child_path, stat)
+        else:
+            print('%s: not a regular file or directory, skipped' % child_path, file=sys.stderr)
+            continue
+        encode_name(child_name) #check the name fits before planning anything
+        entry.children.append(child)
+    return entry
+
+def walk(entry):
+    '''Yield: every Entry under entry, entry first.'''
+    yield entry
+    for child in entry.children or ():
+        for found in walk(child):
+            yield found
+
+def layout(entry, entries_per_block):
+    '''Return: {bucket: [(encoded name, child Entry)]} for the directory entry.'''
+    return plan_buckets([(encode_name(child.name), child) for child in entry.children], entries_per_block)
+
+def plan(root, block_map, dir_index):
+    '''Return: the blocks the tree under root needs besides the root inode.'''
+    empty = bytearray(block_map.block_size)
+    needed = 0
+    for entry in walk(root):
+        if entry.children is None:
+            blocks = -(-entry.stat.st_size // block_map.block_size)
+            if blocks > block_map.max_blocks:
+                raise IOError('%s is too large for the file system' % entry.path)
+            indexes = range(blocks)
+        else:
+            indexes = list(layout(entry, dir_index.entries_per_block))
+            if indexes and max(indexes) >= block_map.max_blocks:
+                raise IOError('%s has too many entries for a directory' % entry.path)
+        needed += (entry is not root) + block_map.count_unmapped_indexes(empty, indexes)
+    return needed
+
+def image_size(block_size, needed, journal_blocks=None):
+    '''Return: the smallest block count that fits needed blocks after the metadata.'''
+    num_blocks = needed + 1
+    while True:
+        sb = Superblock(block_size, num_blocks, journal_blocks=journal_blocks)
+        if sb.root_block + 1 + needed <= num_blocks:
+            return num_blocks
+        num_blocks = sb.root_block + 1 + needed
+
+class Builder(object):
+    '''Lays out a scanned tree in a freshly formatted, open image.'''
+    def __init__(self, sb, run):
+        self.block_map = BlockMap(sb.block_size)
+        self.dir_index = DirectoryIndex(self.block_map)
+        self.block_size = sb.block_size
+        self.run = run
+        self.zero = bytes(sb.block_size)
+        self.files = 0
+        self.data_blocks = 0
+
+    def allocate(self):
+        block_num = allocate_reserved(self.run)
+        if block_num == -1:
+            raise IOError('The image ran out of planned blocks')
+        return block_num
+
+    def new_inode(self, entry, mode, nlinks):
+        entry.location = self.allocate()
+        inode = Inode.new(self.block_size, entry.location, mode | S_IMODE(entry.stat.st_mode), nlinks,
+            entry.stat.st_uid, entry.stat.st_gid, int(time()))
+        inode.mtime, inode.atime = int(entry.stat.st_mtime), int(entry.stat.st_atime)
+        return inode
+
+    def build_dir(self, entry, inode):
+        #buckets first, then the inodes of every entry so they can be filled in
+        buckets = layout(entry, self.dir_index.entries_per_block)
+        bucket_blocks = {}
+        for bucket in sorted(buckets):
+            block_num, _ = self.block_map.map_block(inode.block, bucket, self.allocate)
+            bucket_blocks[bucket] = (block_num, bytearray(self.block_size))
+        child_inodes = []
+        for child in entry.children:
+            if child.children is None:
+                child_inodes.append(self.new_inode(child, S_IFREG, 1))
+            else:
+                child_inodes.append(self.new_inode(child, S_IFDIR, 2 + len(child.children)))
+        for bucket, bucket_entries in buckets.items():
+            _, bucket_block = bucket_blocks[bucket]
+            for slot, (encoded_name, child) in enumerate(bucket_entries):
+                self.dir_index.set_entry(bucket_block, slot, encoded_name, child.location)
+        cache.write_blocks(dict(bucket_blocks.values()))
+        inode.size = (max(buckets) + 1) * self.block_size if buckets else 0
+        inode.nlinks = 2 + len(entry.children)
+        write_inode(inode)
+
+        for child, child_inode in zip(entry.children, child_inodes):
+            if child.children is None:
+                self.build_file(child, child_inode)
+        for child, child_inode in zip(entry.children, child_inodes):
+            if child.children is not None:
+                self.build_dir(child, child_inode)
+
+    def build_file(self, entry, inode):
+        #the data first, so it is one run, then the indirect blocks that map
+        #it. All-zero blocks are left as holes
+        size = 0
+        mapped = []
+        with open(entry.path, 'rb') as host_file:
+            while size < entry.stat.st_size:
+                chunk = host_file.read(min(BATCH_BLOCKS * self.block_size, entry.stat.st_size - size))
+                if not chunk:
+                    break
+                batch = {}
+                for start in range(0, len(chunk), self.block_size):
+                    block = chunk[start:start + self.block_size]
+                    if len(block) < self.block_size:
+                        block += self.zero[len(block):]
+                    if block != self.zero:
+                        block_num = self.allocate()
+                        mapped.append(((size + start) // self.block_size, block_num))
+                        batch[block_num] = block
+                disktools.write_blocks(batch)
+                self.data_blocks += len(batch)
+                size += len(chunk)
+        for index, block_num in mapped:
+            self.block_map.map_block(inode.block, index, self.allocate, block_num)
+        inode.size = size
+        write_inode(inode)
+        self.files += 1
+
+def build_image(source, name=disktools.DISK_NAME, block_size=disktools.BLOCK_SIZE, num_blocks=None,
+        journal_blocks=None):
+    '''Formats name and copies the tree under source into it. Without
+        num_blocks the image is made just large enough.
+        Return: (files, directories under the root, data blocks).
+    '''
+    root = scan(source)
+    block_map = BlockMap(block_size)
+    needed = plan(root, block_map, DirectoryIndex(block_map))
+    if num_blocks is None:
+        num_blocks = image_size(block_size, needed, journal_blocks)
+    sb = Superblock(block_size, num_blocks, journal_blocks=journal_blocks).check()
+    if sb.root_block + 1 + needed > num_blocks:
+        raise IOError('%s needs %d blocks but the image only has %d free' % (
+            source, needed, num_blocks - sb.root_block - 1))
+
+    #there is no calling process outside a mount, so the root's owner comes from source
+    format_disk(name, block_size, num_blocks, journal_blocks, owner=(root.stat.st_uid, root.stat.st_gid))
+    disktools.open_device(name, block_size, num_blocks)
+    #every block but the file data stays in the cache until the end
+    cache.configure(needed + sb.bitmap_blocks + 2)
+    load_bitmap(num_blocks, block_size, sb.bitmap_start)
+    run = Reservation()
+    reserve(run, sb.root_block + 1, needed)
+    builder = Builder(sb, run)
+    try:
+        root_inode = read_inode(sb.root_block)
+        root_inode.mode = S_IFDIR | S_IMODE(root.stat.st_mode)
+        root_inode.uid, root_inode.gid = root.stat.st_uid, root.stat.st_gid
+        root_inode.mtime, root_inode.atime = int(root.stat.st_mtime), int(root.stat.st_atime)
+        builder.build_dir(root, root_inode)
+        release(run)
+        unload_bitmap()
+        cache.sync()
+    finally:
+        cache.close()
+    dirs = sum(1 for entry in walk(root) if entry.children is not None and entry is not root)
+    return builder.files, dirs, builder.data_blocks
+
+def export_dir(fs, path, host_path, chunk_size):
+    '''Copies the directory path of the mounted fs into host_path.
+        Return: (files, directories) copied.
+    '''
+    files = dirs = 0
+    for name, attrs, _ in fs('readdir', path, 0):
+        if name in ('.', '..'):
+            continue
+        child, host_child = path.rstrip("/") + "/" + name, os.path.join(host_path, name)
+        if S_ISDIR(attrs['st_mode']):
+            os.makedirs(host_child, exist_ok=True)
+            child_files, child_dirs = export_dir(fs, child, host_child, chunk_size)
+            files, dirs = files + child_files, dirs + child_dirs + 1
+        elif S_ISREG(attrs['st_mode']):
+            fh = fs('open', child, os.O_RDONLY)
+            try:
+                with open(host_child, 'wb') as host_file:
+                    for offset in range(0, attrs['st_size'], chunk_size):
+                        host_file.write(fs('read', child, chunk_size, offset, fh))
+            finally:
+                fs('release', child, fh)
+            files += 1
+        else:
+            continue
+        #after the contents, so writing them does not change the times
+        os.chmod(host_child, S_IMODE(attrs['st_mode']))
+        os.utime(host_child, (attrs['st_atime'], attrs['st_mtime']))
+    return files, dirs
+
+def export_image(name, dest, chunk_size=BATCH_BLOCKS * disktools.BLOCK_SIZE):
+    '''Copies every file and directory in the image name into dest, with
+        their permissions and times, reading each file in large chunks.
+        Return: (files, directories).
+    '''
+    #small needs libfuse, which building an image does not
+    import small
+    fs = small.Small(name)
+    try:
+        os.makedirs(dest, exist_ok=True)
+        return export_dir(fs, "/", dest, chunk_size)
+    finally:
+        fs('destroy', '/')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--disk', default=disktools.DISK_NAME)
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='make a new image from a host directory')
+    build.add_argument('source')
+    build.add_argument('--block-size', type=int, default=disktools.BLOCK_SIZE)
+    build.add_argument('--num-blocks', type=int, default=None, help='default: just large enough for source')
+    build.add_argument('--journal-blocks', type=int, default=None)
+    export = commands.add_parser('export', help='copy the contents of an image into a host directory')
+    export.add_argument('dest')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'build':
+            files, dirs, blocks = build_image(args.source, args.disk, args.block_size, args.num_blocks,
+                args.journal_blocks)
+            print('%s: %d files, %d directories, %d data blocks' % (args.disk, files, dirs, blocks))
+        elif args.command == 'export':
+            files, dirs = export_image(args.disk, args.dest)
+            print('%s: %d files, %d directories' % (args.dest, files, dirs))
+        else:
+            parser.print_usage()
+            sys.exit(2)
+    except (IOError, OSError) as e:
+        print('mkimage:', e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,242 @@
+# Beverley Sun
+# bsun448
+
+import itertools
+import threading
+from time import time
+from errno import ENOSPC
+from inode import read_inode, write_inode
+from cache import write_blocks, checkpoint
+from bitmap import Reservation, reserve, release, allocate, allocate_reserved, promise, unpromise
+from blockmap import NO_BLOCK
+from readahead import ReadAhead
+from fuse import FuseOSError
+
+#blocks reserved ahead of a file that is being written, growing with the file
+MIN_PREALLOC_BLOCKS = 8
+MAX_PREALLOC_BLOCKS = 256
+
+#unallocated blocks a file can hold in memory before they are allocated
+MAX_DELAYED_BLOCKS = 256
+
+#seconds open files keep timestamps in memory with lazytime
+DEFAULT_LAZYTIME_INTERVAL = 60
+
+class OpenFile(object):
+    '''An inode held in memory while it is open, shared by every handle on it.
+        Block map lookups are remembered so streaming through a file does not
+        walk the indirect blocks again. Changes to the inode are made here and
+        written through with write_inode().
+
+        With lazytime, timestamps set by touch() stay in memory until the
+        inode is next written, which write_times() forces.
+
+        Blocks written where nothing is mapped yet are held in delayed and
+        only allocated by allocate_delayed(), at the latest on the next
+        commit, so they can be given one contiguous run. Allocations come
+        from the file's reservation, which starts right after the last
+        block allocated to it.
+    '''
+    def __init__(self, block_map, location):
+        self.block_map = block_map
+        self.location = location
+        self.inode = read_inode(location)
+        self.blocks = {} #file block index -> disk block, NO_BLOCK for holes
+        self.refs = 0
+        self.unlinked = False #freed on the last release instead of at unlink
+        self.delayed = {} #file block index -> block not allocated yet
+        self.promised = 0 #blocks promised for delayed
+        self.reservation = Reservation()
+        self.goal = None #block to allocate next
+        self.times_dirty = False #timestamps changed since the inode was written
+
+    def lookup(self, index):
+        block_num = self.blocks.get(index)
+        if block_num is None:
+            block_num = self.block_map.lookup(self.inode.block, index)
+            self.blocks[index] = block_num
+        return block_num
+
+    def map_block(self, index):
+        block_num, fresh = self.block_map.map_block(self.inode.block, index, self.allocate_block)
+        self.blocks[index] = block_num
+        return block_num, fresh
+
+    def remap(self, index, block_num):
+        self.blocks[index] = block_num
+        return self.block_map.remap(self.inode.block, index, block_num)
+
+    def allocate_block(self):
+        if not self.reservation:
+            reserve(self.reservation, self.next_goal(), self.prealloc_blocks())
+        block_num = allocate_reserved(self.reservation)
+        if block_num == -1:
+            block_num = allocate(promised=True)
+        if block_num == -1:
+            raise FuseOSError(ENOSPC)
+        self.goal = block_num + 1
+        return block_num
+
+    def next_goal(self):
+        #after the last block of the file, or after the inode of an empty file
+        if self.goal is None:
+            block_size = self.block_map.block_size
+            last = self.lookup(-(-self.inode.size // block_size) - 1) if self.inode.size else NO_BLOCK
+            self.goal = (last if last != NO_BLOCK else self.location) + 1
+        return self.goal
+
+    def prealloc_blocks(self):
+        blocks = max(self.inode.size // self.block_map.block_size, len(self.delayed))
+        return min(MAX_PREALLOC_BLOCKS, max(MIN_PREALLOC_BLOCKS, blocks))
+
+    def promise(self, first, last):
+        '''Promises the blocks that mapping file blocks first..last will need.
+            Return: False if the disk is full.
+        '''
+        for _ in range(2):
+            needed = self.count_unmapped(first, last) - \
+                sum(1 for index in range(first, last + 1) if index in self.delayed)
+            if needed <= 0 or promise(needed):
+                self.promised += max(needed, 0)
+                return True
+            #each write promises the indirect blocks it needs on its own, so
+            #what the file has promised can be more than it will use
+            self.allocate_delayed()
+        return False
+
+    def allocate_delayed(self):
+        '''Maps and writes the delayed blocks, then settles the promise.'''
+        if self.delayed:
+            blocks = {}
+            for index in sorted(self.delayed):
+                block_num, _ = self.map_block(index)
+                blocks[block_num] = self.delayed[index]
+            write_blocks(blocks, metadata=False)
+            self.delayed.clear()
+            self.write_inode()
+        unpromise(self.promised)
+        self.promised = 0
+
+    def close(self, discard=False):
+        '''Allocates the delayed blocks, or drops them with discard, and
+            hands back the reservation. Pending timestamps are written
+            unless the file is being discarded.
+        '''
+        if discard:
+            self.delayed.clear()
+        self.allocate_delayed()
+        release(self.reservation)
+        if not discard:
+            self.write_times()
+
+    def count_unmapped(self, first, last):
+        return self.block_map.count_unmapped(self.inode.block, first, last)
+
+    def truncate(self, first):
+        self.blocks.clear()
+        for index in [index for index in self.delayed if index >= first]:
+            del self.delayed[index]
+        return self.block_map.truncate(self.inode.block, first)
+
+    def touch(self, now, atime=True, mtime=True):
+        #only in memory until the inode is next written
+        if atime:
+            self.inode.atime = now
+        if mtime:
+            self.inode.mtime = now
+        self.times_dirty = True
+
+    def write_times(self):
+        if self.times_dirty:
+            self.write_inode()
+
+    def write_inode(self):
+        write_inode(self.inode)
+        self.times_dirty = False
+
+class OpenFileTable(object):
+    '''File handles handed out by open and create. Handles on the same inode
+        share one OpenFile, which is dropped when the last of them is released.
+
+        lazytime is how many seconds open files may keep timestamp changes
+        in memory, or None to write them straight away.
+    '''
+    def __init__(self, block_map, lazytime=None):
+        self.block_map = block_map
+        self.lazytime = lazytime
+        self.times_written = time()
+        self.handles = {} #fh -> OpenFile
+        self.readahead = {} #fh -> ReadAhead, sequential reads are tracked per handle
+        self.inodes = {} #inode block -> OpenFile
+        self.next_fh = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def open(self, location):
+        '''Return: a new file handle on the inode at location.'''
+        with self.lock:
+            open_file = self.inodes.get(location)
+            if open_file is None:
+                open_file = self.inodes[location] = OpenFile(self.block_map, location)
+            open_file.refs += 1
+            fh = next(self.next_fh)
+            self.handles[fh] = open_file
+            self.readahead[fh] = ReadAhead()
+            return fh
+
+    def get(self, fh):
+        '''Return: the OpenFile for fh, or None if fh is not open.'''
+        return self.handles.get(fh)
+
+    def read_ahead(self, fh):
+        '''Return: the ReadAhead for fh, or None if fh is not open.'''
+        return self.readahead.get(fh)
+
+    def inode(self, location):
+        '''Return: the open inode at location, or a private copy if it is not open.'''
+        with self.lock:
+            open_file = self.inodes.get(location)
+        return open_file if open_file is not None else OpenFile(self.block_map, location)
+
+    def is_open(self, location):
+        return location in self.inodes
+
+    def stat(self, location):
+        '''Return: the attributes of the inode at location, from memory if it is open.'''
+        open_file = self.inodes.get(location)
+        return (open_file.inode if open_file is not None else read_inode(location)).stat()
+
+    def lazy(self, open_file):
+        '''Return: whether open_file can keep its timestamps in memory. A
+            file that is not open has nowhere to keep them.
+        '''
+        return self.lazytime is not None and open_file.refs > 0
+
+    def write_times(self, force=False):
+        '''Writes the pending timestamps of every open file, once lazytime
+            seconds have passed since the last time or now with force.
+        '''
+        if not force and (self.lazytime is None or time() - self.times_written < self.lazytime):
+            return
+        self.times_written = time()
+        for open_file in list(self.inodes.values()):
+            open_file.write_times()
+            checkpoint()
+
+    def release(self, fh):
+        '''Return: the OpenFile if fh was its last handle, otherwise None.'''
+        with self.lock:
+            open_file = self.handles.pop(fh, None)
+            self.readahead.pop(fh, None)
+            if open_file is None:
+                return None
+            open_file.refs -= 1
+            if open_file.refs > 0:
+                return None
+            del self.inodes[open_file.location]
+            return open_file
+
+    def clear(self):
+        with self.lock:
+            self.handles.clear()
+            self.readahead.clear()
+            self.inodes.clear()
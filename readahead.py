@@ -0,0 +1,41 @@
+# Beverley Sun
+# bsun448
+
+#read-ahead windows, in blocks
+MIN_READAHEAD_BLOCKS = 4
+MAX_READAHEAD_BLOCKS = 256
+
+class ReadAhead(object):
+    '''Sequential read detection for one file handle. A read that starts
+        where the last one ended is sequential, and the first one starts a
+        window of blocks to fetch ahead that doubles every time it is used,
+        up to a limit. Any other read closes the window. The next window is
+        asked for as soon as a read gets into the second half of the last
+        one, so it has arrived by the time it is read.
+    '''
+    __slots__ = ('next_offset', 'window', 'fetched')
+
+    def __init__(self):
+        self.next_offset = 0 #files are usually read from the start
+        self.window = 0
+        self.fetched = 0 #block index the last window ended at
+
+    def access(self, offset, size, block_size, max_blocks=MAX_READAHEAD_BLOCKS):
+        '''Records a read of size bytes at offset.
+            Return: (first, end) block indexes to fetch ahead, or None.
+        '''
+        first, last = offset // block_size, (offset + size - 1) // block_size
+        sequential = offset == self.next_offset
+        self.next_offset = offset + size
+        if not sequential:
+            self.window = 0
+            return None
+        if self.window == 0:
+            self.window = min(max_blocks, max(MIN_READAHEAD_BLOCKS, 4 * (last - first + 1)))
+            self.fetched = last + 1
+        if last + 1 + self.window // 2 < self.fetched:
+            return None
+        start = max(self.fetched, last + 1)
+        self.fetched = start + self.window
+        window, self.window = self.window, min(max_blocks, self.window * 2)
+        return start, start + window
@@ -8,105 +8,321 @@ from __future__ import print_function, absolute_import, division
 import logging
 
 from collections import defaultdict
-from errno import ENOENT, ENOSPC, ENOSYS, ENOTEMPTY
-from stat import S_IFDIR, S_IFREG, S_ISDIR
+from contextlib import contextmanager
+from errno import EACCES, EFBIG, EINVAL, ENOENT, ENOSPC, ENOSYS, ENOTEMPTY
+from stat import S_IFDIR, S_IFREG, S_ISDIR, S_ISREG
 from time import time
-from disktools import read_block, write_block, BLOCK_SIZE, NUM_BLOCKS
-from byte_locations import *
-from bitmap import next_avail_block_num, set_bit, clear_bit, num_avail_blocks
+from disktools import open_device, DISK_NAME
+from cache import read_block, write_block, read_blocks, write_blocks, discard_blocks
+from bitmap import allocate, clear_bit, num_avail_blocks, load_bitmap, unload_bitmap
+from bitmap import Reservation, reserve, release, allocate_reserved, promise, unpromise
+from superblock import read_superblock
+from blockmap import BlockMap, NO_BLOCK
+from directory import DirectoryIndex, encode_name
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
-from format import END_OF_FILE, BYTEORDER, STR_ENCODING
+import cache
+from dcache import DentryCache
+from openfiles import OpenFileTable, MAX_DELAYED_BLOCKS, DEFAULT_LAZYTIME_INTERVAL
+from readahead import MAX_READAHEAD_BLOCKS
+from inode import Inode, read_inode, write_inode
+from journal import Journal
+from locks import RWLock, LockTable
+from stats import OpStats, STATS_PATH
+import bitmap
+import disktools
+
+#superblock, block map and directory layout of the mounted disk, set by mount()
+sb = None
+block_map = None
+dir_index = None
+files = None
+dentries = DentryCache()
+
+#directory changes hold the namespace for writing and path lookups for
+#reading, inode locks guard each inode's data and attributes
+namespace = RWLock()
+inode_locks = LockTable()
+
+def mount(disk_name=DISK_NAME, lazytime=None):
+    global sb, block_map, dir_index, files
+    sb = read_superblock(disk_name)
+    block_map = BlockMap(sb.block_size)
+    dir_index = DirectoryIndex(block_map)
+    files = OpenFileTable(block_map, lazytime)
+    open_device(disk_name, sb.block_size, sb.num_blocks)
+
+    #finish whatever the last commit before a crash left in the journal
+    journal = Journal(sb.journal_start, sb.journal_blocks, sb.block_size)
+    replayed = journal.replay()
+    if replayed:
+        logging.info('Replayed %d blocks from the journal', replayed)
+    #the bitmap can change anywhere in a commit, so it always has room
+    cache.get_cache().attach_journal(journal, sb.bitmap_blocks)
+    load_bitmap(sb.num_blocks, sb.block_size, sb.bitmap_start)
+    dentries.clear()
+    return sb
+
+def split_path(path):
+    path_split = path.split("/")
+    return "/" + "/".join(path_split[1:-1]), path_split[-1]
+
+def lookup_block_num(path):
+    if path == "/":
+        return sb.root_block
 
-BLOCK_DATA_SIZE = DATA_END - DATA_START
-OVERFLOW_BLOCK_DATA_SIZE = OVERFLOW_DATA_END - OVERFLOW_DATA_START
+    #answer from the dentry cache if this path has been resolved before
+    found, block_num = dentries.lookup(path)
+    if found:
+        if block_num is None:
+            raise FuseOSError(ENOENT)
+        return block_num
 
-if not hasattr(__builtins__, 'bytes'):
-    bytes = str
+    #resolve the parent first, then look the name up in its index
+    with namespace.reading():
+        parent_path, name = split_path(path)
+        dir_inode = read_inode(lookup_block_num(parent_path))
+        if not S_ISDIR(dir_inode.mode):
+            raise FuseOSError(ENOENT)
+        block_num = dir_index.lookup(dir_inode, name)
+        if block_num is None:
+            dentries.add_negative(path)
+            raise FuseOSError(ENOENT)
+        dentries.add(path, block_num)
+        return block_num
 
-def get_block_from_path(path):
-    if path == "/":
-        return read_block(0)
-    path_array = path.split("/")
-
-    #assume all paths start at the root directory
-    dir_block_to_check = 0
-
-    #iterate through folders in the path
-    for i in range(1, len(path_array)):
-        #get dir info
-        dir_block = read_block(dir_block_to_check)
-        dir_block_nlinks = int.from_bytes(dir_block[NLINKS_START:NLINKS_END], BYTEORDER)
-        dir_block_links = dir_block[DATA_START:DATA_START+dir_block_nlinks-2] #get actual links
-
-        #iterate through all files in directory
-        for block_num in dir_block_links:
-            #get file info
-            block = read_block(block_num) #get file block
-            block_name = block[NAME_START:NAME_END].decode(STR_ENCODING).rstrip('\x00')
-            block_mode = int.from_bytes(block[MODE_START:MODE_END], BYTEORDER)
-
-            if path_array[i] == block_name and i == len(path_array) - 1:
-                return block
-            if path_array[i] == block_name and S_ISDIR(block_mode):
-                dir_block_to_check = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-                break
-            if block_num == dir_block_links[-1]:
-                raise FuseOSError(ENOENT)
-    raise FuseOSError(ENOENT)
-
-def add_link_to_dir(dir_block, link_location):
-    nlinks = int.from_bytes(dir_block[NLINKS_START:NLINKS_END], BYTEORDER) #get current num links
-    dir_block[DATA_START+nlinks-2] = link_location #add the link location to the directory
-    dir_block[NLINKS_START:NLINKS_END] = (nlinks + 1).to_bytes(1, BYTEORDER) #update num links in the dir
-
-    #write the updated block back into disk
-    dir_location = int.from_bytes(dir_block[LOCATION_START:LOCATION_END], BYTEORDER)
-    write_block(dir_location, dir_block)
-
-def rm_link_from_dir(path, block_num_to_remove):
-    #get dir info
-    parent_block = get_block_from_path(path)
-    parent_location = int.from_bytes(parent_block[LOCATION_START:LOCATION_END], BYTEORDER)
-    parent_nlinks = int.from_bytes(parent_block[NLINKS_START:NLINKS_END], BYTEORDER)
-    parent_links = parent_block[DATA_START:DATA_START+parent_nlinks-2]
-
-    #remove the link for the removed link
-    updated_links = [l for l in parent_links if l != block_num_to_remove]
-    
-    #remove all links and them back, except for the removed link
-    parent_block[DATA_START:DATA_END] = bytearray([0]*(DATA_END-DATA_START))
-    parent_block[DATA_START:DATA_START+len(updated_links)] = updated_links
-
-    parent_block[NLINKS_START:NLINKS_END] =(parent_nlinks-1).to_bytes(1, BYTEORDER)
-    write_block(parent_location, parent_block) #update parent block in disk
-
-def init_block_data(block, name, nlinks, block_num, mode):
-    now = int(time())
-    
-    block[MODE_START:MODE_END] = mode.to_bytes(2, BYTEORDER)
-    block[UID_START:UID_END] = fuse_get_context()[0].to_bytes(2, BYTEORDER)
-    block[GID_START:GID_END] = fuse_get_context()[1].to_bytes(2, BYTEORDER)
-    block[NLINKS_START:NLINKS_END] = nlinks.to_bytes(1, BYTEORDER)
-    block[CTIME_START:CTIME_END] = now.to_bytes(4, BYTEORDER)
-    block[MTIME_START:MTIME_END] = now.to_bytes(4, BYTEORDER)
-    block[ATIME_START:ATIME_END] = now.to_bytes(4, BYTEORDER)
-    block[NAME_START:NAME_END] = bytes(name, STR_ENCODING)
-    block[LOCATION_START:LOCATION_END] = (block_num).to_bytes(1, BYTEORDER)
-    block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END] = (END_OF_FILE).to_bytes(1, BYTEORDER)
-    if (S_ISDIR(mode)):
-        block[SIZE_START:SIZE_END] = BLOCK_SIZE.to_bytes(2, BYTEORDER)
-    return block
-
-def remaining_space_on_file_end_block(start_block):
-    block_size = int.from_bytes(start_block[SIZE_START:SIZE_END], BYTEORDER)
-    avail_space_end_block = 0
-    if block_size <= BLOCK_DATA_SIZE:
-        avail_space_end_block = BLOCK_DATA_SIZE - block_size
-    else:
-        avail_space_end_block = OVERFLOW_BLOCK_DATA_SIZE - ((block_size - BLOCK_DATA_SIZE) % OVERFLOW_BLOCK_DATA_SIZE)
-    return avail_space_end_block
+def get_inode_from_path(path):
+    return read_inode(lookup_block_num(path))
+
+@contextmanager
+def locked_inode(path, fh=None, write=False):
+    '''Yield: the OpenFile behind handle fh, or behind path when there is no
+        handle, holding its inode lock. A path stays locked in the namespace
+        too so the file can't be unlinked and freed underneath.
+    '''
+    open_file = files.get(fh) if fh is not None else None
+    if open_file is not None:
+        with inode_lock(open_file.location, write):
+            yield open_file
+        return
+    with namespace.reading():
+        location = lookup_block_num(path)
+        with inode_lock(location, write):
+            yield files.inode(location)
+
+def inode_lock(location, write):
+    return inode_locks.writing(location) if write else inode_locks.reading(location)
+
+def add_link_to_dir(dir_inode, name, link_location):
+    dir_index.add(dir_inode, name, link_location) #add the entry to the directory
+    dir_inode.nlinks += 1
+    write_inode(dir_inode)
+
+def rm_link_from_dir(path, name):
+    #remove the entry, only its bucket is rewritten
+    parent_inode = get_inode_from_path(path)
+    dir_index.remove(parent_inode, name)
+    parent_inode.nlinks -= 1
+    write_inode(parent_inode)
+
+def new_inode(path, nlinks, mode):
+    parent_path, name = split_path(path)
+    encode_name(name) #check the name fits before allocating anything
+    dir_inode = get_inode_from_path(parent_path)
+    block_num = allocate()
+
+    #no available blocks
+    if block_num == -1:
+        raise FuseOSError(ENOSPC)
+
+    #initialise and write block
+    uid, gid, _ = fuse_get_context()
+    write_inode(Inode.new(sb.block_size, block_num, mode, nlinks, uid, gid, int(time())))
+
+    #link it to its parent dir, giving the block back if the dir can't grow
+    try:
+        add_link_to_dir(dir_inode, name, block_num)
+    except OSError:
+        free_blocks([block_num])
+        raise
+    dentries.add(path, block_num)
+    return block_num
+
+def free_file(open_file):
+    open_file.close(discard=True)
+    free_blocks(open_file.truncate(0))
+    free_blocks([open_file.location])
+
+def free_blocks(block_nums):
+    discard_blocks(block_nums)
+    for block_num in block_nums:
+        clear_bit(block_num)
+
+def allocate_delayed():
+    #every commit starts here, while no operation is running. Each file is
+    #complete on its own, so the journal can take them a few at a time
+    if files is not None:
+        for open_file in list(files.inodes.values()):
+            open_file.allocate_delayed()
+            cache.checkpoint()
+
+cache.register_flush_hook(allocate_delayed)
+
+#set while destroy() flushes, so every timestamp kept in memory is written
+unmounting = False
+
+def write_lazy_times():
+    #timestamps kept in memory reach the disk with the first commit after
+    #the lazytime interval
+    if files is not None:
+        files.write_times(force=unmounting)
+
+cache.register_flush_hook(write_lazy_times)
+
+#blocks moved per transaction by defragment()
+DEFRAG_CHUNK_BLOCKS = 64
+
+def count_extents(block_nums):
+    '''Return: the number of contiguous runs in block_nums, in file order.'''
+    return sum(1 for i, block_num in enumerate(block_nums) if i == 0 or block_num != block_nums[i - 1] + 1)
+
+def file_blocks(open_file):
+    '''Return: (index, block) of every mapped data block of open_file.'''
+    mapped = []
+    for index in range(-(-open_file.inode.size // sb.block_size)):
+        block_num = open_file.lookup(index)
+        if block_num != NO_BLOCK:
+            mapped.append((index, block_num))
+    return mapped
+
+def defragment(path):
+    '''Moves the data blocks of the file at path into one run of free
+        blocks, if they are in more than one and a long enough run is free.
+        Each chunk of blocks is moved in its own transaction with the file
+        locked, so this can run while other operations do.
+        Return: the number of blocks moved.
+    '''
+    with cache.transaction():
+        with locked_inode(path, write=True) as open_file:
+            open_file.allocate_delayed()
+            mapped = file_blocks(open_file)
+    if count_extents([block_num for _, block_num in mapped]) <= 1:
+        return 0
+
+    run = Reservation()
+    if not promise(len(mapped)):
+        return 0
+    try:
+        if reserve(run, 0, len(mapped)) < len(mapped):
+            return 0
+        moved, next_index = 0, 0
+        while run:
+            with cache.transaction():
+                with locked_inode(path, write=True) as open_file:
+                    if open_file.unlinked:
+                        break
+                    #the file may have changed since the last chunk, so look again
+                    remaining = [(index, block_num) for index, block_num in file_blocks(open_file)
+                        if index >= next_index]
+                    if not remaining:
+                        break
+                    chunk = remaining[:min(DEFRAG_CHUNK_BLOCKS, len(run))]
+                    old_blocks = read_blocks([block_num for _, block_num in chunk])
+                    new_blocks = {}
+                    for index, old_block_num in chunk:
+                        new_block_num = allocate_reserved(run)
+                        if new_block_num == -1:
+                            break #taken back because the disk filled up
+                        new_blocks[new_block_num] = old_blocks[old_block_num]
+                        open_file.remap(index, new_block_num)
+                        next_index = index + 1
+                    write_blocks(new_blocks, metadata=False)
+                    free_blocks([block_num for index, block_num in chunk if index < next_index])
+                    moved += len(new_blocks)
+                    open_file.write_inode()
+        return moved
+    finally:
+        release(run)
+        unpromise(len(mapped))
+
+#setting this extended attribute on a file of a mounted image defragments it
+DEFRAG_XATTR = "user.small.defragment"
+
+#operations that commit (or close) the journal themselves, make their own
+#transactions, or change nothing, so they don't run inside a transaction
+UNJOURNALED_OPS = frozenset(['init', 'destroy', 'flush', 'fsync', 'setxattr'])
+
+#operations allowed on the read-only stats file
+STATS_OPS = frozenset(['getattr', 'open', 'read', 'release', 'flush', 'fsync', 'getxattr', 'access'])
 
 class Small(LoggingMixIn, Operations):
+    def __init__(self, disk_name=DISK_NAME, writeback_interval=cache.DEFAULT_WRITEBACK_INTERVAL,
+            stats=False, debug=False, lazytime=None, relatime=False):
+        self.disk_name = disk_name
+        self.writeback_interval = writeback_interval
+        self.debug = debug
+        #writes and truncates leave atime alone
+        self.relatime = relatime
+        #per-operation counters, read through STATS_PATH; None turns them off
+        self.stats = OpStats() if stats else None
+        self.stats_snapshot = None
+        self.stats_files = {} #fh -> the report it was opened on
+        mount(disk_name, lazytime)
+
+    def __call__(self, op, *args):
+        if self.stats is None:
+            return self.call(op, *args)
+        if STATS_PATH in args[:2]:
+            return self.stats_call(op, *args)
+        return self.stats.measure(op, self.call, op, *args)
+
+    def call(self, op, *args):
+        #every other operation is one journal transaction
+        if op in UNJOURNALED_OPS:
+            return self.dispatch(op, *args)
+        with cache.transaction():
+            return self.dispatch(op, *args)
+
+    def dispatch(self, op, *args):
+        #LoggingMixIn formats every call and result, so it only runs when debugging
+        if self.debug:
+            return super(Small, self).__call__(op, *args)
+        return Operations.__call__(self, op, *args)
+
+    def stats_report(self):
+        return self.stats.report(
+            device=disktools.stats(),
+            cache=cache.stats(),
+            allocator=bitmap.allocator_stats(),
+            dentries=len(dentries.entries),
+            open_files=len(files.handles)
+        )
+
+    def stats_attrs(self):
+        #the size has to match what a following open reads
+        self.stats_snapshot = self.stats_report()
+        now = int(time())
+        return dict(st_mode=S_IFREG | 0o444, st_nlink=1, st_size=len(self.stats_snapshot),
+            st_ctime=now, st_mtime=now, st_atime=now, st_uid=0, st_gid=0)
+
+    def stats_call(self, op, path, *args):
+        if op not in STATS_OPS or path != STATS_PATH:
+            raise FuseOSError(EACCES)
+        if op == 'getattr':
+            return self.stats_attrs()
+        if op == 'open':
+            fh = next(files.next_fh)
+            self.stats_files[fh] = self.stats_snapshot or self.stats_report()
+            return fh
+        if op == 'read':
+            size, offset, fh = args
+            report = self.stats_files.get(fh) or self.stats_report()
+            return report[offset:offset + size]
+        if op == 'release':
+            self.stats_files.pop(args[0], None)
+        if op == 'getxattr':
+            return ""
+        return 0
+
     def chmod(self, path, mode):
         raise FuseOSError(ENOSYS)
 
@@ -114,49 +330,46 @@ class Small(LoggingMixIn, Operations):
         raise FuseOSError(ENOSYS)
 
     def create(self, path, mode):
-        block_num = next_avail_block_num()
-
-        #no available blocks
-        if block_num == -1:
-            raise FuseOSError(ENOSPC)
-
-        #get short file name
-        path_split = path.split("/")
-        name = path_split[-1]
-
-        #initialise and write block
-        block = read_block(block_num)
-        block = init_block_data(block, name, 1, block_num, S_IFREG | 0o755)
-        write_block(block_num, block)
-        set_bit(block_num)
-
-        #link it to its parent dir
-        path_to_dir = "/" + "/".join(path_split[1:-1])
-        dir_block = get_block_from_path(path_to_dir)
-        add_link_to_dir(dir_block, block_num)
-
-        return block_num
+        with namespace.writing():
+            return files.open(new_inode(path, 1, S_IFREG | 0o755))
+
+    def destroy(self, path):
+        global unmounting
+        #the flush hooks take the delayed blocks and timestamps of every open
+        #file a few files per commit, so closing them leaves little to write
+        unmounting = True
+        try:
+            cache.flush()
+        finally:
+            unmounting = False
+        for open_file in list(files.inodes.values()):
+            if open_file.unlinked:
+                free_file(open_file)
+            else:
+                open_file.close()
+        files.clear()
+        #the last commit still needs the bitmap to tell freed blocks apart
+        cache.close()
+        unload_bitmap()
+        dentries.clear()
+
+    def flush(self, path, fh):
+        #called on every close(2), so dirty blocks are left to fsync, the
+        #writeback timer and unmount rather than committed here
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        #fdatasync does not need the timestamps
+        open_file = files.get(fh) if fh is not None else None
+        if open_file is not None and not datasync:
+            with inode_locks.writing(open_file.location):
+                open_file.write_times()
+        cache.sync()
+        return 0
 
     def getattr(self, path, fh=None):
-        block = get_block_from_path(path)
-        mode = int.from_bytes(block[MODE_START:MODE_END], BYTEORDER)
-        ctime = int.from_bytes(block[CTIME_START:CTIME_END], BYTEORDER)
-        mtime = int.from_bytes(block[MTIME_START:MTIME_END], BYTEORDER)
-        atime = int.from_bytes(block[ATIME_START:ATIME_END], BYTEORDER)
-        nlink = int.from_bytes(block[NLINKS_START:NLINKS_END], BYTEORDER)
-        size = int.from_bytes(block[SIZE_START:SIZE_END], BYTEORDER)
-        uid = int.from_bytes(block[UID_START:UID_END], BYTEORDER)
-        gid = int.from_bytes(block[GID_START:GID_END], BYTEORDER)
-        return dict(
-            st_mode=mode,
-            st_ctime=ctime,
-            st_mtime=mtime,
-            st_atime=atime,
-            st_nlink=nlink,
-            st_size=size,
-            st_uid = uid,
-            st_gid = gid
-        )
+        with locked_inode(path, fh) as open_file:
+            return open_file.inode.stat()
 
     def getxattr(self, path, name, position=0):
         return ""
@@ -164,78 +377,86 @@ class Small(LoggingMixIn, Operations):
     def listxattr(self, path):
         raise FuseOSError(ENOSYS)
 
-    def mkdir(self, path, mode):
-        block_num = next_avail_block_num()
-
-        #no free blocks available
-        if block_num == -1:
-            raise FuseOSError(ENOSPC)
-
-        #get short name of dir
-        path_split = path.split("/")
-        name = path_split[-1]
+    def init(self, path):
+        cache.get_cache().start_writeback(self.writeback_interval)
 
-        #initialise and write block
-        block = read_block(block_num)
-        block = init_block_data(block, name, 2, block_num, S_IFDIR | 0o755)
-        write_block(block_num, block)
-        set_bit(block_num)
-
-        #link dir to parent dir
-        path_to_dir = "/" + "/".join(path_split[1:-1])
-        dir_block = get_block_from_path(path_to_dir)
-        add_link_to_dir(dir_block, block_num)
+    def mkdir(self, path, mode):
+        with namespace.writing():
+            new_inode(path, 2, S_IFDIR | 0o755)
 
     def open(self, path, flags):
-        block = get_block_from_path(path)
-        location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-        return location
+        with namespace.reading():
+            location = lookup_block_num(path)
+            with inode_locks.reading(location):
+                return files.open(location)
 
     def read(self, path, size, offset, fh):
-        block = get_block_from_path(path)
-
-        block_size = int.from_bytes(block[SIZE_START:SIZE_END], BYTEORDER)
-        if size > block_size - offset:
-            size = block_size - offset
-        
-        #calculate offset for the required block
-        num_blocks_for_offset = 0 #number of blocks needed to traverse to get to the offset
-        if offset >= BLOCK_DATA_SIZE:
-            offset -= BLOCK_DATA_SIZE
-            num_blocks_for_offset += 1 + int(offset/OVERFLOW_BLOCK_DATA_SIZE)
-            offset = offset % OVERFLOW_BLOCK_DATA_SIZE
-
-        #find block to start reading from
-        for _ in range(num_blocks_for_offset):
-            next_block_num = int.from_bytes(block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-            block = read_block(next_block_num)
-
-        data = b""
-        #special case to read from the first block
-        if num_blocks_for_offset == 0:
-            data += block[DATA_START+offset:DATA_END]
-        else:
-            data += block[OVERFLOW_DATA_START+offset:OVERFLOW_DATA_END]
-
-        #keep reading blocks until the data length >= the size
-        while len(data) < size:
-            next_block_num = int.from_bytes(block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-            block = read_block(next_block_num)
-            data += block[OVERFLOW_DATA_START:OVERFLOW_DATA_END]
-
-        return data[0:size]
+        with locked_inode(path, fh) as open_file:
+            file_size = open_file.inode.size
+            if offset >= file_size:
+                return b""
+            if size > file_size - offset:
+                size = file_size - offset
+
+            #look up each block covering the range in the block map, then read them together
+            first, last = offset // sb.block_size, (offset + size - 1) // sb.block_size
+            block_nums = [open_file.lookup(index) for index in range(first, last + 1)]
+            blocks = read_blocks([block_num for block_num in block_nums if block_num != NO_BLOCK])
+            data = bytearray()
+            for index, data_block_num in enumerate(block_nums, first):
+                if index in open_file.delayed:
+                    data += open_file.delayed[index]
+                elif data_block_num == NO_BLOCK:
+                    data += bytes(sb.block_size) #holes read as zeros
+                else:
+                    data += blocks[data_block_num]
+
+            readahead = files.read_ahead(fh)
+            if readahead is not None:
+                self.read_ahead(open_file, readahead.access(offset, size, sb.block_size, MAX_READAHEAD_BLOCKS))
+
+            start = offset - first * sb.block_size
+            return bytes(data[start:start+size])
+
+    def read_ahead(self, open_file, window):
+        #advise the kernel of the mapped blocks of the window, up to the end of the file
+        if window is None:
+            return
+        first, end = window
+        end = min(end, -(-open_file.inode.size // sb.block_size))
+        block_nums = [open_file.lookup(index) for index in range(first, end) if index not in open_file.delayed]
+        cache.prefetch([block_num for block_num in block_nums if block_num != NO_BLOCK])
 
     def readdir(self, path, fh):
-        block = get_block_from_path(path)
-        files = ['.', '..']
-
-        nlinks = int.from_bytes(block[NLINKS_START:NLINKS_END], BYTEORDER)
-        if nlinks > 2:
-            links = block[DATA_START:DATA_END]
-            for i in range(0,nlinks-2):
-                file_or_dir = read_block(links[i])
-                files.append(file_or_dir[NAME_START:NAME_END].decode(STR_ENCODING).rstrip("\x00"))
-        return files
+        #return each entry with its attributes so the kernel can skip a
+        #getattr per entry, and remember the child paths for later lookups
+        with namespace.reading():
+            dir_inode = get_inode_from_path(path)
+            parent_path, _ = split_path(path)
+            entries = [
+                ('.', dir_inode.stat(), 0),
+                ('..', (dir_inode if path == "/" else get_inode_from_path(parent_path)).stat(), 0)
+            ]
+
+            prefix = path.rstrip("/") + "/"
+            for name, location in dir_index.entries(dir_inode):
+                dentries.add(prefix + name, location)
+                entries.append((name, files.stat(location), 0))
+            if path == "/" and self.stats is not None:
+                entries.append((STATS_PATH[1:], self.stats_attrs(), 0))
+            return entries
+
+    def release(self, path, fh):
+        open_file = files.get(fh)
+        if open_file is None:
+            return 0
+        with inode_locks.writing(open_file.location):
+            if files.release(fh) is not None:
+                if open_file.unlinked:
+                    free_file(open_file)
+                else:
+                    open_file.close()
+        return 0
 
     def readlink(self, path):
         raise FuseOSError(ENOSYS)
@@ -244,159 +465,183 @@ class Small(LoggingMixIn, Operations):
         raise FuseOSError(ENOSYS)
 
     def rename(self, old, new):
-        block = get_block_from_path(old)
-        block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-
-        #rename
-        new_path_split = new.split("/")
-        new_name = new_path_split[len(new_path_split) - 1]
-        block[NAME_START:NAME_END] = bytes(new_name.ljust(NAME_END-NAME_START, "\x00"), STR_ENCODING)
-
-        write_block(block_location, block)
+        with namespace.writing():
+            block_location = lookup_block_num(old)
+            old_parent_path, old_name = split_path(old)
+            new_parent_path, new_name = split_path(new)
+            encode_name(new_name)
+
+            #replace whatever new currently names
+            try:
+                target_location = lookup_block_num(new)
+            except OSError:
+                target_location = None
+            if target_location == block_location:
+                return
+            if target_location is not None:
+                if S_ISDIR(read_inode(target_location).mode):
+                    self.rmdir(new)
+                else:
+                    self.unlink(new)
+
+            #link under the new name before unlinking the old one
+            add_link_to_dir(get_inode_from_path(new_parent_path), new_name, block_location)
+            rm_link_from_dir(old_parent_path, old_name)
+
+            dentries.invalidate(old)
+            dentries.add_negative(old)
+            dentries.invalidate(new)
+            dentries.add(new, block_location)
 
     def rmdir(self, path):
-        block = get_block_from_path(path)
-        nlinks = int.from_bytes(block[NLINKS_START:NLINKS_END], BYTEORDER)
+        with namespace.writing():
+            dir_inode = get_inode_from_path(path)
         
-        if nlinks > 2:
-            raise FuseOSError(ENOTEMPTY)
-        else:
-            block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-            path_split = path.split("/")
+            if dir_inode.nlinks > 2:
+                raise FuseOSError(ENOTEMPTY)
+            else:
+                block_location = dir_inode.location
+                parent_dir_path, name = split_path(path)
 
-            #remove link from parent dir
-            parent_dir_path = "/" + "/".join(path_split[1:-1])
-            rm_link_from_dir(parent_dir_path, block_location)
+                #remove link from parent dir
+                rm_link_from_dir(parent_dir_path, name)
 
-            #remove the dir
-            write_block(block_location, bytearray([0]*BLOCK_SIZE))
-            clear_bit(block_location)
+                #remove the dir and its buckets
+                free_blocks(block_map.truncate(dir_inode.block, 0))
+                free_blocks([block_location])
+                dentries.invalidate(path)
+                dentries.add_negative(path)
 
     def setxattr(self, path, name, value, options, position=0):
-        raise FuseOSError(ENOSYS)
+        #the only attribute is a command, run in transactions of its own
+        if name != DEFRAG_XATTR:
+            raise FuseOSError(ENOSYS)
+        with locked_inode(path) as open_file:
+            if not S_ISREG(open_file.inode.mode):
+                raise FuseOSError(EINVAL)
+        defragment(path)
+        return 0
 
     def statfs(self, path):
-        return dict(f_bsize=BLOCK_SIZE, f_blocks=NUM_BLOCKS, f_bavail=num_avail_blocks())
+        return dict(f_bsize=sb.block_size, f_blocks=sb.num_blocks, f_bavail=num_avail_blocks())
 
     def symlink(self, target, source):
         raise FuseOSError(ENOSYS)
 
     def truncate(self, path, length, fh=None):
-        #get block information
-        block = get_block_from_path(path)
-        block_size = int.from_bytes(block[SIZE_START:SIZE_END], BYTEORDER)
-        block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-        block_data = self.read(path, block_size, 0, fh)
-        new_data = block_data[:length].ljust(length, b"\x00")
-
-        #delete all data from block
-        next_block_num = int.from_bytes(block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-        empty_block = bytearray([0]*BLOCK_SIZE)
-        while next_block_num != END_OF_FILE:
-            next_block = read_block(next_block_num)
-            write_block(next_block_num, empty_block)
-            clear_bit(next_block_num)
-            next_block_num = int.from_bytes(next_block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-
-        #reset block data
-        block[DATA_START:DATA_END] = bytearray([0]*BLOCK_DATA_SIZE)
-        block[SIZE_START:SIZE_END] = (0).to_bytes(2, BYTEORDER)
-        block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END] = END_OF_FILE.to_bytes(1, BYTEORDER)
-        
-        #write new block with truncated data
-        write_block(block_location, block)
-        self.write(path, new_data, 0, fh)
-        self.utimens(path)
+        with locked_inode(path, fh, write=True) as open_file:
+            inode = open_file.inode
+
+            if length < inode.size:
+                #free every block past the new end
+                free_blocks(open_file.truncate(-(-length // sb.block_size)))
+
+                #zero the rest of the new last block so growing again reads zeros
+                if length % sb.block_size:
+                    last_block = open_file.delayed.get(length // sb.block_size)
+                    last_block_num = open_file.lookup(length // sb.block_size)
+                    if last_block is not None:
+                        last_block[length % sb.block_size:] = bytes(sb.block_size - length % sb.block_size)
+                    elif last_block_num != NO_BLOCK:
+                        last_block = read_block(last_block_num)
+                        last_block[length % sb.block_size:] = bytes(sb.block_size - length % sb.block_size)
+                        write_block(last_block_num, last_block, metadata=False)
+
+            #growing leaves a hole, which reads as zeros
+            resized = length != inode.size
+            inode.size = length
+            open_file.touch(int(time()), atime=not self.relatime)
+            if resized or not files.lazy(open_file):
+                open_file.write_inode()
 
     def unlink(self, path):
-        block = get_block_from_path(path)
-        block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-
-        #remove link from parent dir
-        path_split = path.split("/")
-        parent_dir_path = "/" + "/".join(path_split[1:len(path_split)-1])
-        rm_link_from_dir(parent_dir_path, block_location)
-
-        #remove the actual file
-        next_block_num = int.from_bytes(block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-        write_block(block_location, bytearray([0]*BLOCK_SIZE)) #zero out the removed file
-        clear_bit(block_location)
-        while next_block_num != END_OF_FILE: #remove all subsequent blocks of the file
-            next_block = read_block(next_block_num)
-            write_block(next_block_num, bytearray([0]*BLOCK_SIZE))
-            clear_bit(next_block_num)
-            next_block_num = int.from_bytes(next_block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
+        with namespace.writing():
+            block_location = lookup_block_num(path)
+
+            #remove link from parent dir
+            parent_dir_path, name = split_path(path)
+            rm_link_from_dir(parent_dir_path, name)
+            dentries.add_negative(path)
+
+            #remove the actual file, or leave that to the last release if it is open
+            with inode_locks.writing(block_location):
+                open_file = files.inode(block_location)
+                if files.is_open(block_location):
+                    open_file.unlinked = True
+                else:
+                    free_file(open_file)
 
     def utimens(self, path, times=None):
         now = int(time())
         atime, mtime = times if times else (now, now)
 
-        block = get_block_from_path(path)
-        block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-        
-        block[ATIME_START:ATIME_END] = int(atime).to_bytes(4, BYTEORDER)
-        block[MTIME_START:MTIME_END] = int(mtime).to_bytes(4, BYTEORDER)
-
-        write_block(block_location, block)
+        with locked_inode(path, write=True) as open_file:
+            open_file.inode.atime, open_file.inode.mtime = int(atime), int(mtime)
+            open_file.write_inode()
 
     def write(self, path, data, offset, fh):
-        block = get_block_from_path(path)
-        block_location = int.from_bytes(block[LOCATION_START:LOCATION_END], BYTEORDER)
-        block_size = int.from_bytes(block[SIZE_START:SIZE_END], BYTEORDER)
-        
-        # calculate total available space
-        avail_space_end_block = remaining_space_on_file_end_block(block)
-        free_blocks_avail_space = num_avail_blocks() * (OVERFLOW_BLOCK_DATA_SIZE)
-        total_avail_space = avail_space_end_block + free_blocks_avail_space
-        if len(data) > total_avail_space:
-            raise FuseOSError(ENOSPC)
-
-        #read in all data and add in new data at the offset
-        block_data = self.read(path, block_size, 0, fh)
-        new_data = block_data[:offset].ljust(offset, b"\x00") + data + block_data[offset + len(data):]
-        block[SIZE_START:SIZE_END] = len(new_data).to_bytes(2, BYTEORDER)
-
-        #special case to insert data in first block
-        if len(new_data) <= BLOCK_DATA_SIZE:
-            block[DATA_START:DATA_END] = new_data.ljust(BLOCK_DATA_SIZE, b"\x00")
-            new_data = b""
-        else:
-            block[DATA_START:DATA_END] = new_data[0:BLOCK_DATA_SIZE]
-            new_data = new_data[BLOCK_DATA_SIZE:]
-        self.utimens(path)
-        write_block(block_location, block)
-        
-        #insert remaining/leftover data in different blocks
-        current_block_num = block_location
-        while new_data != b"":
-            next_block_num = int.from_bytes(block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END], BYTEORDER)
-            if next_block_num == END_OF_FILE:
-                #create new block if previous block was end of file
-                next_block_num = next_avail_block_num()
-                
-                #set the next block number on the current block
-                block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END] = next_block_num.to_bytes(1, BYTEORDER)
-                write_block(current_block_num, block)
-
-                #read in next block
-                block = read_block(next_block_num)
-                set_bit(next_block_num)
-                block[NEXTBLOCKNUM_START:NEXTBLOCKNUM_END] = (END_OF_FILE).to_bytes(1, BYTEORDER)
-            else:
-                block = read_block(next_block_num)
-            
-            #insert data into the block
-            current_block_num = next_block_num
-            block[OVERFLOW_DATA_START:OVERFLOW_DATA_END] = new_data[:OVERFLOW_BLOCK_DATA_SIZE].ljust(OVERFLOW_BLOCK_DATA_SIZE, b"\x00")
-            new_data = new_data[OVERFLOW_BLOCK_DATA_SIZE:]
-            write_block(next_block_num, block)
-        return len(data)
+        with locked_inode(path, fh, write=True) as open_file:
+            inode = open_file.inode
+            size = inode.size
+            open_file.touch(int(time()), atime=not self.relatime)
+            if len(data) == 0:
+                if not files.lazy(open_file):
+                    open_file.write_inode()
+                return 0
+
+            #check the blocks covering the write can be mapped
+            end = offset + len(data)
+            first, last = offset // sb.block_size, (end - 1) // sb.block_size
+            if last >= block_map.max_blocks:
+                raise FuseOSError(EFBIG)
+            if not open_file.promise(first, last):
+                raise FuseOSError(ENOSPC)
+
+            #only the blocks covering [offset, end) are written, and blocks
+            #that are not mapped yet wait in memory to be allocated together
+            block_nums = {index: open_file.lookup(index) for index in range(first, last + 1)}
+            partial = [block_nums[index] for index in (first, last)
+                if block_nums[index] != NO_BLOCK and (index * sb.block_size < offset or
+                    (index + 1) * sb.block_size > end)]
+            written = read_blocks(partial)
+            for index, data_block_num in block_nums.items():
+                block_start = index * sb.block_size
+                start, stop = max(offset, block_start), min(end, block_start + sb.block_size)
+                if data_block_num == NO_BLOCK:
+                    data_block = open_file.delayed.get(index)
+                    if data_block is None:
+                        data_block = open_file.delayed[index] = bytearray(sb.block_size)
+                    data_block[start-block_start:stop-block_start] = data[start-offset:stop-offset]
+                elif stop - start == sb.block_size:
+                    written[data_block_num] = data[start-offset:stop-offset]
+                else:
+                    written[data_block_num][start-block_start:stop-block_start] = data[start-offset:stop-offset]
+            write_blocks(written, metadata=False)
+
+            inode.size = max(inode.size, end)
+            #a file that is not open has nowhere to keep delayed blocks
+            if len(open_file.delayed) >= MAX_DELAYED_BLOCKS or not open_file.refs:
+                open_file.allocate_delayed()
+            #with lazytime an overwrite only changes the timestamps in memory
+            if inode.size != size or not files.lazy(open_file):
+                open_file.write_inode()
+            return len(data)
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('mount')
+    parser.add_argument('--disk', default=DISK_NAME)
+    parser.add_argument('--cache-blocks', type=int, default=cache.DEFAULT_CAPACITY)
+    parser.add_argument('--writeback-interval', type=float, default=cache.DEFAULT_WRITEBACK_INTERVAL)
+    parser.add_argument('--stats', action='store_true', help='count operations and serve them in ' + STATS_PATH)
+    parser.add_argument('--debug', action='store_true', help='log every operation')
+    parser.add_argument('--lazytime', type=float, nargs='?', const=DEFAULT_LAZYTIME_INTERVAL, default=None,
+        help='keep timestamps of open files in memory for up to this many seconds')
+    parser.add_argument('--relatime', action='store_true', help='do not update atime on writes')
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(Small(), args.mount, foreground=True)
\ No newline at end of file
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    cache.configure(args.cache_blocks)
+    fuse = FUSE(Small(args.disk, args.writeback_interval, args.stats, args.debug, args.lazytime, args.relatime),
+        args.mount, foreground=True)
\ No newline at end of file
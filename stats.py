@@ -0,0 +1,65 @@
+# Beverley Sun
+# bsun448
+
+import json
+import threading
+from time import perf_counter
+
+STATS_PATH = "/.stats"
+HISTOGRAM_BUCKETS = 32
+
+class OpCounter(object):
+    '''Calls, errors and a latency histogram for one operation. Bucket i
+        counts calls that took less than 2**i microseconds (and at least
+        half that).
+    '''
+    __slots__ = ('calls', 'errors', 'seconds', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, seconds, failed):
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def report(self):
+        return dict(
+            calls=self.calls,
+            errors=self.errors,
+            total_ms=self.seconds * 1e3,
+            mean_us=self.seconds * 1e6 / self.calls if self.calls else 0.0,
+            latency_us={'<%d' % (1 << i): n for i, n in enumerate(self.histogram) if n}
+        )
+
+class OpStats(object):
+    '''Per-operation counters, filled in by measure() around every call.'''
+    def __init__(self):
+        self.ops = {}
+        self.lock = threading.Lock()
+
+    def measure(self, op, func, *args):
+        start = perf_counter()
+        failed = True
+        try:
+            result = func(*args)
+            failed = False
+            return result
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                counter = self.ops.get(op)
+                if counter is None:
+                    counter = self.ops[op] = OpCounter()
+                counter.record(elapsed, failed)
+
+    def report(self, **sections):
+        '''Return: the counters, and any extra sections, as JSON bytes.'''
+        with self.lock:
+            ops = {op: counter.report() for op, counter in self.ops.items()}
+        return (json.dumps(dict(sections, ops=ops), indent=2, sort_keys=True) + "\n").encode()
@@ -0,0 +1,74 @@
+# Beverley Sun
+# bsun448
+
+import struct
+from disktools import BLOCK_SIZE, NUM_BLOCKS, DISK_NAME
+import bitmap
+import journal
+
+MAGIC = b"SMFS"
+VERSION = 5
+PTR_WIDTH = 4
+MIN_BLOCK_SIZE = 128
+
+#magic, version, pointer width, block size, block count, bitmap start, bitmap blocks,
+#journal start, journal blocks, root block
+SUPERBLOCK_STRUCT = struct.Struct("<4sHHIQQQQQQ")
+
+class Superblock(object):
+    '''Geometry of a disk image, stored at the start of block 0.'''
+    def __init__(self, block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS, ptr_width=PTR_WIDTH,
+            version=VERSION, bitmap_start=bitmap.BITMAP_START, bitmap_blocks=None,
+            journal_start=None, journal_blocks=None, root_block=None):
+        self.version = version
+        self.ptr_width = ptr_width
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.bitmap_start = bitmap_start
+        self.bitmap_blocks = bitmap_blocks
+        if self.bitmap_blocks is None:
+            self.bitmap_blocks = bitmap.bitmap_blocks(num_blocks, block_size)
+        self.journal_start = journal_start
+        if self.journal_start is None:
+            self.journal_start = self.bitmap_start + self.bitmap_blocks
+        self.journal_blocks = journal_blocks
+        if self.journal_blocks is None:
+            self.journal_blocks = journal.journal_blocks(num_blocks, block_size)
+        self.root_block = root_block
+        if self.root_block is None:
+            self.root_block = self.journal_start + self.journal_blocks
+
+    def pack(self):
+        return SUPERBLOCK_STRUCT.pack(MAGIC, self.version, self.ptr_width,
+            self.block_size, self.num_blocks, self.bitmap_start, self.bitmap_blocks,
+            self.journal_start, self.journal_blocks, self.root_block)
+
+    @classmethod
+    def unpack(cls, data):
+        (magic, version, ptr_width, block_size, num_blocks, bitmap_start, bitmap_blocks,
+            journal_start, journal_blocks, root_block) = SUPERBLOCK_STRUCT.unpack_from(data)
+        if magic != MAGIC:
+            raise IOError('Not a formatted disk image')
+        return cls(block_size, num_blocks, ptr_width, version, bitmap_start, bitmap_blocks,
+            journal_start, journal_blocks, root_block)
+
+    def check(self):
+        '''Raises IOError unless this code can mount the image.'''
+        if self.version != VERSION:
+            raise IOError('Unsupported file system version %d' % self.version)
+        if self.ptr_width != PTR_WIDTH:
+            raise IOError('Unsupported block pointer width %d' % self.ptr_width)
+        if self.block_size < MIN_BLOCK_SIZE or self.block_size & (self.block_size - 1):
+            raise IOError('Block size must be a power of two of at least %d' % MIN_BLOCK_SIZE)
+        #every transaction has to fit the journal in one piece
+        min_journal_blocks = journal.min_journal_blocks(self.bitmap_blocks, self.block_size)
+        if self.journal_blocks < min_journal_blocks:
+            raise IOError('The journal needs at least %d blocks' % min_journal_blocks)
+        if self.num_blocks >= 1 << (8 * self.ptr_width) or self.num_blocks <= self.root_block:
+            raise IOError('Block count does not fit the block pointers')
+        return self
+
+def read_superblock(name=DISK_NAME):
+    '''Reads and checks the superblock before the disk is mapped.'''
+    with open(name, 'rb') as disk:
+        return Superblock.unpack(disk.read(SUPERBLOCK_STRUCT.size)).check()